@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the Helios Power Gauge.
+
+Runs without the display being connected, so it can also be used on a
+development machine. Usage: ./benchmark.py [packing] [render] [cycle] [startup] [spi] [rollups]
+
+Rendering needs the font "arial.ttf" next to helios.py or a font given with
+--font.
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+import collections
+
+from PIL import Image, ImageDraw
+
+import helios
+
+
+def reference_getbuffer(image):
+    """Original per-pixel implementation of Display._getbuffer, kept as golden reference."""
+    buf = [0xFF] * (int(helios.Display.WIDTH/8) * helios.Display.HEIGHT)
+    image_monocolor = image.convert('1')
+    imwidth, imheight = image_monocolor.size
+    pixels = image_monocolor.load()
+    for x in range(imwidth):
+        for y in range(imheight):
+            if pixels[x, y] == 0:
+                x_dst = imwidth - x - 1
+                buf[x_dst * (helios.Display.HEIGHT // 8) + (y // 8)] &= ~(0x80 >> (y % 8))
+    return buf
+
+
+def sample_images():
+    """Returns a few test frames covering empty, full, noisy and drawn content."""
+    size = (helios.Display.WIDTH, helios.Display.HEIGHT)
+    images = {
+        'white': Image.new(mode='1', size=size, color=1),
+        'black': Image.new(mode='1', size=size, color=0),
+    }
+
+    rng = random.Random(42)
+    noise = Image.new(mode='1', size=size, color=1)
+    noise.putdata([rng.randint(0, 1) for _ in range(size[0] * size[1])])
+    images['noise'] = noise
+
+    shapes = Image.new(mode='1', size=size, color=1)
+    draw = ImageDraw.Draw(shapes)
+    draw.rectangle((1, 20, 29, 102), fill=1, outline=0)
+    draw.line(((0, 0), (295, 127)), fill=0, width=3)
+    draw.polygon(((148, 35), (140, 20), (156, 20)), fill=0, outline=0)
+    draw.point((295, 0), fill=0)
+    images['shapes'] = shapes
+
+    # greyscale input exercises the dithering done by convert('1')
+    images['grey'] = Image.linear_gradient('L').resize(size)
+    return images
+
+
+class NullDisplay(helios.Display):
+    """Display that drops all frames, to measure rendering alone."""
+    def display(self, blackimage, ryimage, force=False, region=None):
+        pass
+
+
+class UncachedDesigner(helios.Designer):
+    """Designer drawing every frame from scratch, as reference for the cached one."""
+    def _new_frame(self):
+        return self._draw_background()
+
+    def _draw_text(self, coord, text, font, anchor=None):
+        self.draw.text(coord, text, font=font, fill=0, anchor=anchor)
+        return self.draw.textbbox(coord, text, font=font, anchor=anchor)
+
+    def _draw_car(self, type_str):
+        with Image.open(os.path.join(helios.Designer.RESSOURCE_DIR, helios.Designer.CAR_PATH)) as car:
+            self.car = car.copy()
+        super()._draw_car(type_str)
+
+    def _draw_arrow(self, coord0, coord1, invert=False, draw_head=True):
+        helios.Designer._arrow_geometry.cache_clear()
+        return super()._draw_arrow(coord0, coord1, invert, draw_head)
+
+
+def sample_data():
+    """Returns measuring data covering all drawn elements and value ranges."""
+    rfid_card = next(iter(helios.WALLBOX_RFID_CARDS), 0x1234)
+    helios.WALLBOX_RFID_CARDS.setdefault(rfid_card, 'Car')
+    base = {
+        'battery_charge_level': 55, 'battery_charge_status': 'Charging', 'battery_charge_power': 1200,
+        'power_use': 800, 'power_from_grid': 0, 'power_from_pv': 3000, 'power_self_consumption': 800,
+        'power_feed_in': 1000, 'charging_status': 2, 'total_energy': 100, 'active_power': 0, 'rfid_card': 0,
+    }
+    variants = [
+        {},
+        {'battery_charge_level': 95, 'battery_charge_status': 'Discharging', 'power_from_pv': 0},
+        {'battery_charge_status': 'Idle', 'power_from_grid': 5400, 'power_feed_in': 0, 'power_use': 12500},
+        {'charging_status': 3, 'active_power': 11000, 'rfid_card': rfid_card, 'battery_charge_level': 8},
+    ]
+    data = [helios.MeasuringData.from_values(dict(base, **variant)) for variant in variants]
+    data.append(helios.MeasuringData.from_values(base, stale={'battery_charge_level': 60, 'power_from_grid': None, 'active_power': 60}))
+    return data
+
+
+def timeit(func, repeat):
+    """Returns the mean runtime of func in seconds."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_packing(args):
+    display = helios.Display()
+    ok = True
+    for name, image in sample_images().items():
+        if bytes(reference_getbuffer(image)) != bytes(display._getbuffer(image)):
+            print(f'Golden output mismatch for image "{name}"')
+            ok = False
+    if not ok:
+        return 1
+    print('Golden output: ok')
+
+    image = sample_images()['noise']
+    t_ref = timeit(lambda: reference_getbuffer(image), max(1, args.repeat // 100))
+    t_new = timeit(lambda: display._getbuffer(image), args.repeat)
+    print(f'Packing (reference): {t_ref * 1000:8.3f} ms/frame')
+    print(f'Packing (current):   {t_new * 1000:8.3f} ms/frame')
+    print(f'Speedup: {t_ref / t_new:.0f}x')
+    return 0
+
+
+def bench_render(args):
+    designer = helios.Designer(NullDisplay())
+    reference = UncachedDesigner(NullDisplay())
+    data = sample_data()
+    ok = True
+    for i, d in enumerate(data):
+        designer.draw_data(d)
+        reference.draw_data(d)
+        if designer.image_buffer.tobytes() != reference.image_buffer.tobytes():
+            print(f'Golden output mismatch for sample {i}')
+            ok = False
+    if not ok:
+        return 1
+    print('Golden output: ok')
+
+    def render(designer):
+        for d in data:
+            designer.draw_data(d)
+    t_ref = timeit(lambda: render(reference), max(1, args.repeat // 10)) / len(data)
+    t_new = timeit(lambda: render(designer), args.repeat) / len(data)
+    print(f'Render (uncached): {t_ref * 1000:8.3f} ms/frame')
+    print(f'Render (cached):   {t_new * 1000:8.3f} ms/frame')
+    print(f'Speedup: {t_ref / t_new:.1f}x')
+    return 0
+
+
+def bench_cycle(args):
+    """Runs complete render and display cycles on the virtual display and reports the time of each stage."""
+    transport = helios.VirtualTransport(time_scale=0)
+    display = helios.Display(transport)
+    stages = collections.Counter()
+
+    def timed(name, func):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stages[name] += time.perf_counter() - start
+        return wrapper
+    display._getbuffer = timed('packing', display._getbuffer)
+    display.display = timed('display', display.display)
+
+    data = sample_data()
+    cycles = max(1, args.repeat // 10)
+    with display:
+        designer = helios.Designer(display)
+        draw_data = timed('cycle', designer.draw_data)
+        stages.clear()
+        counters = lambda: (transport.busy_time, transport.transfer_time, transport.bytes_sent, transport.refreshes, transport.partial_refreshes, display.refreshes_skipped)
+        start = counters()
+        for i in range(cycles):
+            draw_data(data[i % len(data)])
+        busy_time, transfer_time, bytes_sent, refreshes, partial_refreshes, skipped = (end - begin for end, begin in zip(counters(), start))
+
+    print(f'Cycles: {cycles}, refreshes: {refreshes} ({partial_refreshes} partial), skipped: {skipped}')
+    print(f'Render:              {(stages["cycle"] - stages["display"]) / cycles * 1000:8.3f} ms/cycle')
+    print(f'Packing:             {stages["packing"] / cycles * 1000:8.3f} ms/cycle')
+    print(f'Display (CPU):       {(stages["display"] - stages["packing"]) / cycles * 1000:8.3f} ms/cycle')
+    print(f'Display (modeled):   {busy_time / cycles * 1000:8.0f} ms/cycle')
+    print(f'SPI bytes sent:      {bytes_sent / cycles:8.0f} bytes/cycle')
+    print(f'SPI transfer:        {transfer_time / cycles * 1000:8.3f} ms/cycle at {transport.speed_hz / 1e6:.0f} MHz')
+    return 0
+
+
+def bench_startup(args):
+    """Measures the time from the start until the first frame is shown, with and without a saved frame."""
+    code = 'import time; start = time.perf_counter(); import helios; print(time.perf_counter() - start)'
+    repeat = max(1, args.repeat // 40)
+    t_import = min(
+        float(subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                             capture_output=True, text=True, check=True).stdout)
+        for _ in range(repeat))
+    print(f'Import helios:       {t_import * 1000:8.1f} ms')
+
+    # the second start shows other data than the saved frame, as the gauge does after a restart
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        frame_path = os.path.join(tmp_dir, 'frame.bin')
+        for name, data in (('without saved frame', sample_data()[0]), ('with saved frame', sample_data()[1])):
+            transport = helios.VirtualTransport(time_scale=0)
+            start = time.perf_counter()
+            with helios.Display(transport, frame_path=frame_path) as display:
+                designer = helios.Designer(display)
+                designer.draw_data(data)
+                elapsed = time.perf_counter() - start
+            print(f'First frame ({name}): {elapsed * 1000:8.1f} ms CPU, {transport.busy_time:5.1f} s modeled, '
+                  f'{transport.refreshes} refreshes')
+    return 0
+
+
+class NullTransport:
+    """Transport dropping all transfers, to measure the CPU time of the transfer path alone."""
+    def __getattr__(self, name):
+        return lambda *args: None
+
+    def get_pin_busy(self):
+        return 1
+
+    def writebytes2(self, data):
+        len(data)
+
+
+def reference_send(display, buffer):
+    """Original transfer of a frame as list of ints, kept as reference."""
+    display._send_command(helios.Display.EPD_CMD_DISPLAY_START_BW)
+    display._set_pin_dc(1)
+    display.transport.writebytes2(list(buffer))
+
+
+def bench_spi(args):
+    """Measures the transfer time per frame and runs the clock calibration on the virtual display."""
+    display = helios.Display(NullTransport())
+    buffer = display._getbuffer(sample_images()['noise'])
+    t_ref = timeit(lambda: reference_send(display, buffer), args.repeat)
+    t_new = timeit(lambda: display._send_data2(buffer), args.repeat)
+    print(f'Transfer CPU (list):     {t_ref * 1000:8.3f} ms/frame')
+    print(f'Transfer CPU (buffer):   {t_new * 1000:8.3f} ms/frame')
+    for speed in helios.DISPLAY_SPI_CALIBRATION_SPEEDS:
+        # both layers are sent for a full refresh
+        print(f'Transfer at {speed / 1e6:4.0f} MHz:   {2 * len(buffer) * 8 / speed * 1000:8.3f} ms/frame')
+
+    state_dir = helios.STATE_DIR
+    with tempfile.TemporaryDirectory() as helios.STATE_DIR:
+        try:
+            # the busy pin has to be observable, so the virtual display cannot run at time_scale 0
+            transport = helios.VirtualTransport(time_scale=0.01)
+            with helios.Display(transport) as display:
+                speed = display.calibrate_spi()
+            print(f'Calibrated clock (virtual, limit {helios.VirtualTransport.MAX_SPEED_HZ / 1e6:.0f} MHz): {speed / 1e6:.0f} MHz')
+        finally:
+            helios.STATE_DIR = state_dir
+    # the clock one step below the highest one within the limit is expected, as margin
+    expected = [speed for speed in helios.DISPLAY_SPI_CALIBRATION_SPEEDS if speed <= helios.VirtualTransport.MAX_SPEED_HZ][-2]
+    return 0 if speed == expected else 1
+
+
+def check_wallbox_energy(path):
+    """Checks that only the energy charged between real counter readings is booked, returns the error or None."""
+    base = sample_data()[0].__dict__
+    samples = [
+        # at the start the counter is stale and holds the default of 0
+        (0, {'stale': {'total_energy': None}, 'total_energy': 0}),
+        (60, {'total_energy': 12345.6}),
+        (120, {'stale': {'total_energy': 60}, 'total_energy': 12345.6}),
+        (180, {'total_energy': 12346.6}),
+    ]
+    with helios.Rollups(path) as rollups:
+        for offset, values in samples:
+            values = dict(values)
+            stale = values.pop('stale', None)
+            rollups.append(helios.MeasuringData.from_values(dict(base, **values), stale=stale, timestamp=1_700_000_000 + offset))
+        charged = sum(bucket['metrics'].get('wallbox_energy', {}).get('sum', 0) for bucket in rollups.query('1m'))
+    return None if round(charged) == 1000 else f'{charged:.0f} Wh charged instead of 1000 Wh'
+
+
+def bench_rollups(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        error = check_wallbox_energy(os.path.join(tmp_dir, 'check.json'))
+        if error:
+            print(f'Golden output mismatch for wallbox energy: {error}')
+            return 1
+        print('Golden output: ok')
+
+        data = sample_data()[0]
+        with helios.Rollups(os.path.join(tmp_dir, 'rollups.json')) as rollups:
+            samples = 7 * 24 * 60
+            start = time.perf_counter()
+            for i in range(samples):
+                rollups.append(data, timestamp=1_700_000_000 + i * 60)
+            t_append = (time.perf_counter() - start) / samples
+            t_query = timeit(lambda: rollups.query('1h', 1_700_000_000 + 86400, 1_700_000_000 + 2 * 86400), args.repeat)
+    print(f'Append:              {t_append * 1000:8.3f} ms/sample')
+    print(f'Query (1 day of 1h): {t_query * 1000:8.3f} ms')
+    return 0
+
+
+BENCHMARKS = {
+    'packing': bench_packing,
+    'render': bench_render,
+    'cycle': bench_cycle,
+    'startup': bench_startup,
+    'spi': bench_spi,
+    'rollups': bench_rollups,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Helios Power Gauge benchmarks')
+    parser.add_argument('benchmark', nargs='*', help=f'benchmarks to run: {", ".join(BENCHMARKS)} (default: all)')
+    parser.add_argument('-n', '--repeat', type=int, default=200, help='number of iterations per measurement')
+    parser.add_argument('--font', help='path of the font used instead of arial.ttf')
+    parser.add_argument('--calibrate-spi', action='store_true',
+                        help='find and save a reliable SPI clock of the display, used if DISPLAY_SPI_USE_CALIBRATION is set')
+    args = parser.parse_args()
+    if args.font:
+        helios.Designer.FONT_PATH = os.path.abspath(args.font)
+    if args.calibrate_spi:
+        with helios.Display() as display:
+            print(f'SPI clock: {display.calibrate_spi() / 1e6:.0f} MHz')
+        return 0
+    for name in args.benchmark:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown benchmark: {name}')
+
+    ret = 0
+    for name in args.benchmark or BENCHMARKS:
+        print(f'== {name} ==')
+        ret |= BENCHMARKS[name](args)
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,31 +1,124 @@
 #!/usr/bin/env python3
 
+import io
 import os
 import time
+import json
 import math
+import mmap
+import bisect
+import select
+import struct
+import zlib
 import datetime
+import functools
+import contextlib
+import threading
+import statistics
+import collections
+import http.server
+import urllib.error
 import urllib.parse
+import urllib.request
+import concurrent.futures
 
-import spidev
-import gpiozero
 from PIL import Image, ImageDraw, ImageFont
 
-import requests
-from pymodbus.client import ModbusTcpClient
-from pymodbus.payload import BinaryPayloadDecoder
-from pymodbus.constants import Endian
-
 
 VERBOSE = False
+# data is read every SAMPLE_TIME seconds, the display is only refreshed on significant changes, but at most every
+# DISPLAY_MIN_REFRESH_TIME and at least every DISPLAY_REFRESH_TIME seconds
+SAMPLE_TIME = 60
+DISPLAY_MIN_REFRESH_TIME = 2 * 60
 DISPLAY_REFRESH_TIME = 10 * 60
+# relative change of a power value and minimum change in W or % considered significant
+DISPLAY_POWER_CHANGE = 0.2
+DISPLAY_POWER_CHANGE_MIN = 100
+DISPLAY_LEVEL_CHANGE = 5
+# only refresh the changed part of the display, with a full refresh after the given number of partial refreshes
+DISPLAY_PARTIAL_REFRESH = True
+DISPLAY_FULL_REFRESH_INTERVAL = 6
+# maximum time in seconds to wait for the display to finish an operation
+DISPLAY_BUSY_TIMEOUT = 30
+# display connected by SPI ('spi') or simulated without hardware ('virtual')
+DISPLAY_BACKEND = 'spi'
+# SPI clock of the display in Hz, replaced by the clock saved by Display.calibrate_spi() only if
+# DISPLAY_SPI_USE_CALIBRATION is set, and the clocks tried by the calibration in ascending order, which stay within the
+# 10 MHz write clock of the UC8151 datasheet
+DISPLAY_SPI_SPEED = 4_000_000
+DISPLAY_SPI_USE_CALIBRATION = False
+DISPLAY_SPI_SPEED_FILE = 'helios_spi_speed.json'
+DISPLAY_SPI_CALIBRATION_SPEEDS = (2_000_000, 4_000_000, 6_000_000, 8_000_000, 10_000_000)
+# last shown frame, so that a restart does not need to clear the display
+DISPLAY_FRAME_FILE = 'helios_frame.bin'
+
+# port of the Prometheus metrics endpoint on localhost (0 to disable) and file the metrics are written to ('' to disable)
+METRICS_PORT = 9101
+METRICS_TEXTFILE = ''
+
+# deadline in seconds for each data source, a source missing it is replaced by its last known values
+SOURCE_DEADLINES = {
+    'power_flow': 6,
+    'power_details': 6,
+    'converter': 3,
+    'wallbox': 3,
+}
+
+# local Modbus sources are read in the background every SAMPLER_INTERVAL seconds (0 to disable) and shown as the
+# statistic ('ewma', 'mean', 'median', 'min', 'max' or 'last') of the last SAMPLER_WINDOW seconds, the EWMA has a
+# time constant of SAMPLER_EWMA_TIME seconds
+SAMPLER_INTERVAL = 5
+SAMPLER_WINDOW = 5 * 60
+SAMPLER_EWMA_TIME = 60
+SAMPLER_STATISTIC = 'ewma'
+
+# frames shown on the display are served to other gauges and browsers at FRAME_SERVER_PORT (0 to disable), e.g.
+# http://helios:9103/, and a gauge with FRAME_SOURCE_URL set only shows the frames of that server ('' to
+# disable), e.g. 'http://helios:9103/frame.bin'
+FRAME_SERVER_HOST = '0.0.0.0'
+FRAME_SERVER_PORT = 0
+FRAME_SOURCE_URL = ''
+
+# directory for all files persisted between restarts
+STATE_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# number of samples kept in the history file and number of samples collected before they are written
+HISTORY_FILE = 'helios_history.bin'
+HISTORY_SIZE = 7 * 24 * 60
+HISTORY_FLUSH_SAMPLES = 10
+
+# rollups of all samples with the resolutions and number of buckets kept, written every ROLLUPS_FLUSH_INTERVAL seconds
+# and queried as JSON on localhost at ROLLUPS_PORT (0 to disable)
+ROLLUPS_FILE = 'helios_rollups.json'
+ROLLUPS_RESOLUTIONS = {
+    '1m': (60, 24 * 60),
+    '15m': (15 * 60, 7 * 24 * 4),
+    '1h': (60 * 60, 31 * 24),
+    '1d': (24 * 60 * 60, 10 * 366),
+}
+ROLLUPS_FLUSH_INTERVAL = 15 * 60
+ROLLUPS_PORT = 9102
 
 # TODO: Add API key and site id
 SOLAREDGE_API_KEY = ''
 SOLAREDGE_SITE_ID = ''
+SOLAREDGE_API_URL = 'https://monitoringapi.solaredge.com'
+# the API allows 300 requests per day, which are spread over the day with more requests during daylight hours
+SOLAREDGE_DAILY_LIMIT = 300
+SOLAREDGE_DAYLIGHT_HOURS = (6, 21)
+SOLAREDGE_DAYLIGHT_WEIGHT = 3
+SOLAREDGE_MIN_INTERVAL = 60
+# relative change of a value that is considered fast and temporarily doubles the polling rate
+SOLAREDGE_FAST_CHANGE = 0.25
+# time in seconds of power details kept locally and the statistic shown from it ('latest', 'mean' or 'median')
+SOLAREDGE_DETAILS_WINDOW = 60 * 60
+SOLAREDGE_DETAILS_STATISTIC = 'latest'
 
 # TODO: Add IP and port
 CONVERTER_IP = '192.168.0.100'
 CONVERTER_PORT = 502
+# read all converter values by SunSpec Modbus instead of the SolarEdge API
+CONVERTER_PREFER_MODBUS = False
 WALLBOX_IP = '192.168.0.101'
 WALLBOX_PORT = 502
 
@@ -35,6 +128,143 @@ WALLBOX_RFID_CARDS = {
 }
 
 
+def write_atomically(path, data):
+    """Writes a file as a whole, so that a crash never leaves a partly written file behind."""
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+    os.replace(tmp_file, path)
+
+
+def serve_http(host, port, handle, name):
+    """
+    Serves GET requests in a background thread. The function handle gets the
+    path, the query parameters and the request headers and returns status,
+    headers and body of the response.
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            status, headers, body = handle(url.path, dict(urllib.parse.parse_qsl(url.query)), self.headers)
+            self.send_response(status)
+            for header, value in headers.items():
+                self.send_header(header, value)
+            # a 304 response must not announce a length different from the one of the full response
+            if status != 304:
+                self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name=name, daemon=True).start()
+    return server
+
+
+class Histogram:
+    """Counts observed values in fixed buckets, each bucket holding all values up to its upper bound."""
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def __str__(self):
+        bounds = [f'<={bucket}' for bucket in self.buckets] + [f'>{self.buckets[-1]}']
+        return ', '.join(f'{bound}: {count}' for bound, count in zip(bounds, self.counts))
+
+
+class Metrics:
+    """
+    Registry of counters and histograms, exported in the Prometheus text
+    format together with the values returned by registered collectors.
+    """
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(Metrics.BUCKETS)
+            self.histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observes the wall time of a block in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def collector(self, func):
+        """Registers a function returning (name, labels, value) tuples, evaluated on every export."""
+        self.collectors.append(func)
+        return func
+
+    def _format_labels(self, labels, **extra):
+        labels = dict(labels, **extra)
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+    def export(self):
+        with self.lock:
+            samples = [(name, dict(labels), value) for (name, labels), value in self.counters.items()]
+            samples += [(name, dict(labels), value) for (name, labels), value in self.histograms.items()]
+        for collector in self.collectors:
+            samples += list(collector())
+
+        lines = []
+        types = {}
+        for name, labels, value in sorted(samples, key=lambda sample: sample[0]):
+            metric_type = 'histogram' if isinstance(value, Histogram) else 'counter' if name.endswith('_total') else 'gauge'
+            if name not in types:
+                types[name] = metric_type
+                lines.append(f'# TYPE {name} {metric_type}')
+            if isinstance(value, Histogram):
+                cumulative = 0
+                for bucket, count in zip(value.buckets, value.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{self._format_labels(labels, le=bucket)} {cumulative}')
+                lines.append(f'{name}_bucket{self._format_labels(labels, le="+Inf")} {value.count}')
+                lines.append(f'{name}_sum{self._format_labels(labels)} {value.sum}')
+                lines.append(f'{name}_count{self._format_labels(labels)} {value.count}')
+            else:
+                lines.append(f'{name}{self._format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """Writes all metrics to a file, e.g. for the textfile collector of the node exporter."""
+        write_atomically(path, self.export())
+
+    def serve(self, port):
+        """Serves all metrics on localhost in a background thread."""
+        return serve_http('127.0.0.1', port, lambda path, params, headers: (
+            200, {'Content-Type': 'text/plain; version=0.0.4'}, self.export().encode()), 'helios-metrics')
+
+
+METRICS = Metrics()
+
+
 class Display:
     WIDTH = 296
     HEIGHT = 128
@@ -49,72 +279,126 @@ class Display:
     EPD_CMD_VCOM_DATA_INTERVAL = 0x50
     EPD_CMD_RESOLUTION_SETTING = 0x61
     EPD_CMD_GET_STATUS = 0x71
+    EPD_CMD_PARTIAL_WINDOW = 0x90
+    EPD_CMD_PARTIAL_IN = 0x91
+    EPD_CMD_PARTIAL_OUT = 0x92
     EPD_PARAM_DEEP_SLEEP_CHECK_CODE = 0xa5
 
-    def __enter__(self):
-        self.GPIO_RST_PIN = gpiozero.LED("GPIO17")
-        self.GPIO_DC_PIN = gpiozero.LED("GPIO25")
-        self.GPIO_BUSY_PIN = gpiozero.Button("GPIO24", pull_up = False)
-        self.spi = spidev.SpiDev()
-        self.spi.open(0, 0)
-        self.spi.max_speed_hz = 4_000_000
-        self.spi.mode = 0
+    BUFFER_SIZE = WIDTH * HEIGHT // 8
+    BUFFER_WHITE = bytes([0xff]) * BUFFER_SIZE
+
+    FRAME_MAGIC = b'HLFB'
+
+    def __init__(self, transport=None, frame_path=None):
+        """
+        If frame_path is given, the buffers shown on the display are saved
+        there after every refresh. On the next start the display is not
+        cleared, since it still shows the saved frame.
+        """
+        self.frame_path = frame_path
+        if transport is None:
+            transport = VirtualTransport(image_path=os.path.join(STATE_DIR, 'helios_display.png')) if DISPLAY_BACKEND == 'virtual' else SpiTransport()
+        self.transport = transport
+        # buffers currently shown on the display, used to skip refreshes when nothing changed
+        self.last_black_buffer = None
+        self.last_ry_buffer = None
+        # whether the display RAM holds the last buffers, which is not the case after a reset
+        self.ram_valid = False
+        self.refreshes_skipped = 0
+        self.partial_refreshes_since_full = 0
 
+    def __enter__(self):
+        self.transport.open()
         self._init_display()
-        self.clear()
+        if not self._load_frame():
+            self.clear()
         return self
 
+    def _load_frame(self):
+        """Restores the buffers of the frame still shown from the last run and returns whether that worked."""
+        if not self.frame_path:
+            return False
+        try:
+            with open(self.frame_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return False
+        if len(data) != len(Display.FRAME_MAGIC) + 2 * Display.BUFFER_SIZE or not data.startswith(Display.FRAME_MAGIC):
+            return False
+        data = data[len(Display.FRAME_MAGIC):]
+        self.last_black_buffer = data[:Display.BUFFER_SIZE]
+        self.last_ry_buffer = data[Display.BUFFER_SIZE:]
+        return True
+
+    def _save_frame(self):
+        if not self.frame_path:
+            return
+        write_atomically(self.frame_path, Display.FRAME_MAGIC + self.last_black_buffer + self.last_ry_buffer)
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._sleep()
-        self.spi.close()
-        self.GPIO_RST_PIN.off()
-        self.GPIO_DC_PIN.off()
-        del self.spi
-        del self.GPIO_RST_PIN
-        del self.GPIO_DC_PIN
-        del self.GPIO_BUSY_PIN
+        self.transport.close()
         return False
 
     def _set_pin_rst(self, value):
-        self.GPIO_RST_PIN.on() if value else self.GPIO_RST_PIN.off()
+        self.transport.set_pin_rst(value)
 
     def _set_pin_dc(self, value):
-        self.GPIO_DC_PIN.on() if value else self.GPIO_DC_PIN.off()
+        self.transport.set_pin_dc(value)
 
     def _get_pin_busy(self):
-        return self.GPIO_BUSY_PIN.value
+        return self.transport.get_pin_busy()
+
+    def _wait_pin_busy(self, timeout):
+        """Waits for the rising edge of the busy pin and returns whether the display became idle."""
+        return self.transport.wait_pin_busy(timeout)
 
     def _spi_writebyte(self, data):
-        self.spi.writebytes(data)
+        self.transport.writebytes(data)
 
     def _spi_writebyte2(self, data):
-        self.spi.writebytes2(data)
+        self.transport.writebytes2(data)
+
+    def _delay(self, seconds):
+        self.transport.delay(seconds)
 
     def _reset(self):
         self._set_pin_rst(1)
-        time.sleep(0.200)
+        self._delay(0.200)
         self._set_pin_rst(0)
-        time.sleep(0.002)
+        self._delay(0.002)
         self._set_pin_rst(1)
-        time.sleep(0.200)
+        self._delay(0.200)
 
-    def _send_command(self, command):
+    def _send_command(self, command, params=b''):
+        """Sends a command and all of its parameters in one write."""
         self._set_pin_dc(0)
-        self._spi_writebyte([command])
-
-    def _send_data(self, data):
-        self._set_pin_dc(1)
-        self._spi_writebyte([data])
+        self._spi_writebyte(bytes([command]))
+        if params:
+            self._set_pin_dc(1)
+            self._spi_writebyte(bytes(params))
+        METRICS.inc('helios_spi_bytes_total', 1 + len(params))
 
     def _send_data2(self, data):
         self._set_pin_dc(1)
-        self._spi_writebyte2(data)
+        with METRICS.timer('helios_stage_seconds', stage='spi_transfer'):
+            self._spi_writebyte2(memoryview(data))
+        METRICS.inc('helios_spi_bytes_total', len(data))
 
     def _read_busy(self):
+        with METRICS.timer('helios_stage_seconds', stage='read_busy'):
+            self._wait_idle()
+
+    def _wait_idle(self):
+        # the status has to be requested again and again until the display is idle, but the busy pin edge ends the
+        # wait right away instead of after the next full poll interval
+        deadline = time.monotonic() + DISPLAY_BUSY_TIMEOUT
         self._send_command(Display.EPD_CMD_GET_STATUS)
         while self._get_pin_busy() == 0:
+            if time.monotonic() > deadline:
+                raise HeliosException('Timeout waiting for display')
             self._send_command(Display.EPD_CMD_GET_STATUS)
-            time.sleep(0.200)
+            self._wait_pin_busy(0.200)
 
     def _init_display(self):
         self._reset()
@@ -122,16 +406,9 @@ class Display:
         self._send_command(Display.EPD_CMD_POWER_ON)
         self._read_busy()
 
-        self._send_command(Display.EPD_CMD_PANEL_SETTING)
-        self._send_data(0x8f)
-
-        self._send_command(Display.EPD_CMD_RESOLUTION_SETTING)
-        self._send_data(0x80)
-        self._send_data(0x01)
-        self._send_data(0x28)
-
-        self._send_command(Display.EPD_CMD_VCOM_DATA_INTERVAL)
-        self._send_data(0x77)
+        self._send_command(Display.EPD_CMD_PANEL_SETTING, [0x8f])
+        self._send_command(Display.EPD_CMD_RESOLUTION_SETTING, [0x80, 0x01, 0x28])
+        self._send_command(Display.EPD_CMD_VCOM_DATA_INTERVAL, [0x77])
 
         self._send_command(Display.EPD_CMD_POWER_OFF)
         self._read_busy()
@@ -139,72 +416,680 @@ class Display:
     def _sleep(self):
         self._send_command(Display.EPD_CMD_POWER_OFF)
         self._read_busy()
-        self._send_command(Display.EPD_CMD_DEEP_SLEEP)
-        self._send_data(Display.EPD_PARAM_DEEP_SLEEP_CHECK_CODE)
-        time.sleep(2.000)
+        self._send_command(Display.EPD_CMD_DEEP_SLEEP, [Display.EPD_PARAM_DEEP_SLEEP_CHECK_CODE])
+        self._delay(2.000)
+
+    def _check_command(self):
+        """Resets the display and returns whether it reacts to a command with its busy pin."""
+        self._reset()
+        self._send_command(Display.EPD_CMD_POWER_ON)
+        accepted = self._get_pin_busy() == 0
+        try:
+            self._read_busy()
+            self._send_command(Display.EPD_CMD_POWER_OFF)
+            self._read_busy()
+        except HeliosException:
+            return False
+        return accepted
+
+    def calibrate_spi(self, speeds=DISPLAY_SPI_CALIBRATION_SPEEDS, rounds=3):
+        """
+        Finds the highest SPI clock at which the display reliably accepts
+        commands and saves the next lower one as margin, which is used from
+        the next start on if DISPLAY_SPI_USE_CALIBRATION is set.
+
+        Only the acceptance of commands is checked: the display has no data
+        output, so a command counts as accepted if the busy pin reacts to it.
+        Whether frame data arrives intact at that clock is not verified.
+        """
+        accepted = []
+        for speed in speeds:
+            self.transport.set_speed(speed)
+            if not all(self._check_command() for _ in range(rounds)):
+                break
+            accepted.append(speed)
+        if not accepted:
+            raise HeliosException('Display does not react to commands at any SPI clock')
+        best = accepted[-2] if len(accepted) > 1 else accepted[0]
+        self.transport.set_speed(best)
+        self._init_display()
+        self.ram_valid = False
+
+        write_atomically(os.path.join(STATE_DIR, DISPLAY_SPI_SPEED_FILE), json.dumps({'speed_hz': best}))
+        return best
+
+    def display(self, blackimage, ryimage, force=False, region=None):
+        """
+        Sends the given images or buffers to the display and refreshes it. A
+        value of None leaves the respective layer untouched. When all given
+        buffers match what the display already shows, the slow refresh is
+        skipped unless force is set.
+
+        The optional region (x0, y0, x1, y1) in image coordinates marks the
+        only part of the image that changed. If partial refresh is enabled,
+        just this window is transferred and refreshed.
+        """
+        with METRICS.timer('helios_stage_seconds', stage='getbuffer'):
+            if isinstance(blackimage, Image.Image):
+                blackimage = self._getbuffer(blackimage)
+            if isinstance(ryimage, Image.Image):
+                ryimage = self._getbuffer(ryimage)
+        if blackimage != None:
+            blackimage = bytes(blackimage)
+        if ryimage != None:
+            ryimage = bytes(ryimage)
+
+        black_changed = blackimage != None and blackimage != self.last_black_buffer
+        ry_changed = ryimage != None and ryimage != self.last_ry_buffer
+        if not force and not black_changed and not ry_changed:
+            self.refreshes_skipped += 1
+            METRICS.inc('helios_display_refreshes_total', type='skipped')
+            if VERBOSE:
+                print('Display content unchanged, skipping refresh')
+            return
+
+        if (region and not force and DISPLAY_PARTIAL_REFRESH and self.ram_valid
+                and self.partial_refreshes_since_full < DISPLAY_FULL_REFRESH_INTERVAL):
+            blackbuffer = blackimage or self.last_black_buffer
+            rybuffer = ryimage or self.last_ry_buffer
+            # the given region is relative to the last rendered frame, which might not be the one shown, e.g. if its
+            # refresh failed, so all differences to the shown buffers are refreshed as well
+            for diff in (self._get_diff_region(blackbuffer, self.last_black_buffer), self._get_diff_region(rybuffer, self.last_ry_buffer)):
+                if diff:
+                    region = (min(region[0], diff[0]), min(region[1], diff[1]), max(region[2], diff[2]), max(region[3], diff[3]))
+            self._display_partial(blackbuffer, rybuffer, region)
+            return
+
+        if not self.ram_valid:
+            # after a reset both layers have to be sent, since the RAM content is undefined
+            blackimage = blackimage or self.last_black_buffer
+            ryimage = ryimage or self.last_ry_buffer
 
-    def display(self, blackimage, ryimage):
         self._send_command(Display.EPD_CMD_POWER_ON)
         self._read_busy()
 
         if blackimage != None:
-            if isinstance(blackimage, Image.Image):
-                blackimage = self._getbuffer(blackimage)
             self._send_command(Display.EPD_CMD_DISPLAY_START_BW)
             self._send_data2(blackimage)
+            self.last_black_buffer = blackimage
 
         if ryimage != None:
-            if isinstance(ryimage, Image.Image):
-                ryimage = self._getbuffer(ryimage)
             self._send_command(Display.EPD_CMD_DISPLAY_START_R)
             self._send_data2(ryimage)
+            self.last_ry_buffer = ryimage
 
         self._send_command(Display.EPD_CMD_DISPLAY_REFRESH)
-        time.sleep(0.200)
+        self._delay(0.200)
         self._read_busy()
 
         self._send_command(Display.EPD_CMD_POWER_OFF)
         self._read_busy()
+        self.partial_refreshes_since_full = 0
+        self.ram_valid = self.last_black_buffer != None and self.last_ry_buffer != None
+        METRICS.inc('helios_display_refreshes_total', type='full')
+        self._save_frame()
+
+    def _get_diff_region(self, buffer, last_buffer):
+        """Returns the region in image coordinates of all bytes differing between two buffers, or None."""
+        row_size = Display.HEIGHT // 8
+        v_min = v_max = h_min = h_max = None
+        for v in range(Display.WIDTH):
+            row = slice(v * row_size, (v + 1) * row_size)
+            if buffer[row] == last_buffer[row]:
+                continue
+            diff = int.from_bytes(buffer[row], 'big') ^ int.from_bytes(last_buffer[row], 'big')
+            first = row_size - 1 - (diff.bit_length() - 1) // 8
+            last = row_size - 1 - ((diff & -diff).bit_length() - 1) // 8
+            if v_min is None:
+                v_min, h_min, h_max = v, first, last
+            h_min = min(h_min, first)
+            h_max = max(h_max, last)
+            v_max = v
+        if v_min is None:
+            return None
+        return Display.WIDTH - 1 - v_max, h_min * 8, Display.WIDTH - 1 - v_min, h_max * 8 + 7
+
+    def _get_window(self, region):
+        """
+        Converts a region in image coordinates to a window in display
+        coordinates. The display counts its horizontal axis along the image
+        height in whole bytes and its vertical axis from the right image border.
+        """
+        x0, y0, x1, y1 = region
+        x0 = min(max(int(x0), 0), Display.WIDTH - 1)
+        x1 = min(max(int(math.ceil(x1)), x0), Display.WIDTH - 1)
+        y0 = min(max(int(y0), 0), Display.HEIGHT - 1)
+        y1 = min(max(int(math.ceil(y1)), y0), Display.HEIGHT - 1)
+        h_start = y0 & 0xf8
+        h_end = y1 | 0x07
+        v_start = Display.WIDTH - 1 - x1
+        v_end = Display.WIDTH - 1 - x0
+        return h_start, h_end, v_start, v_end
+
+    def _crop_buffer(self, buffer, window):
+        """Extracts the byte columns of a window from a full display buffer."""
+        h_start, h_end, v_start, v_end = window
+        row_size = Display.HEIGHT // 8
+        buffer = memoryview(buffer)
+        return b''.join(buffer[v * row_size + h_start // 8:v * row_size + h_end // 8 + 1] for v in range(v_start, v_end + 1))
+
+    def _display_partial(self, blackbuffer, rybuffer, region):
+        window = self._get_window(region)
+        h_start, h_end, v_start, v_end = window
+
+        self._send_command(Display.EPD_CMD_POWER_ON)
+        self._read_busy()
+
+        self._send_command(Display.EPD_CMD_PARTIAL_IN)
+        self._send_command(Display.EPD_CMD_PARTIAL_WINDOW, [h_start, h_end, v_start >> 8, v_start & 0xff, v_end >> 8, v_end & 0xff, 0x01])
+
+        self._send_command(Display.EPD_CMD_DISPLAY_START_BW)
+        self._send_data2(self._crop_buffer(blackbuffer, window))
+        self._send_command(Display.EPD_CMD_DISPLAY_START_R)
+        self._send_data2(self._crop_buffer(rybuffer, window))
+        self.last_black_buffer = blackbuffer
+        self.last_ry_buffer = rybuffer
+
+        self._send_command(Display.EPD_CMD_DISPLAY_REFRESH)
+        self._delay(0.200)
+        self._read_busy()
+        self._send_command(Display.EPD_CMD_PARTIAL_OUT)
+
+        self._send_command(Display.EPD_CMD_POWER_OFF)
+        self._read_busy()
+        self.partial_refreshes_since_full += 1
+        METRICS.inc('helios_display_refreshes_total', type='partial')
+        self._save_frame()
 
     def clear(self):
-        self.display([0xff] * int(Display.WIDTH * Display.HEIGHT / 8), [0xff] * int(Display.WIDTH * Display.HEIGHT / 8))
+        self.display(Display.BUFFER_WHITE, Display.BUFFER_WHITE, force=True)
 
-    def _getbuffer(self, image):
+    @staticmethod
+    def _getbuffer(image):
         """Transpose image data. PIL image uses 0,0 for top left corner with direct pixel access. The display uses
         8 Pixel per byte, with the first pixel beeing the top bit of the first byte and the top right corner of the
-        display. The pixels are drawn by cols from top-right to bottom-right, ending bottom-left with the last pixel."""
-        buf = [0xFF] * (int(Display.WIDTH/8) * Display.HEIGHT)
-        image_monocolor = image.convert('1')
-        imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-        for x in range(imwidth):
-            for y in range(imheight):
-                if pixels[x, y] == 0:
-                    x_dst = imwidth - x - 1
-                    buf[x_dst * (Display.HEIGHT // 8) + (y // 8)] &= ~(0x80 >> (y % 8))
-        return buf
+        display. The pixels are drawn by cols from top-right to bottom-right, ending bottom-left with the last pixel.
+
+        Rotating the image by 90 degrees counter-clockwise turns the rightmost column into the first row, so PIL's
+        own MSB-first packing of a '1' image already yields the layout expected by the display."""
+        return image.convert('1').transpose(Image.Transpose.ROTATE_90).tobytes()
+
+    @staticmethod
+    def buffers_to_image(blackbuffer, rybuffer):
+        """Returns the RGB image shown for the given display buffers."""
+        size = (Display.HEIGHT, Display.WIDTH)
+        black = Image.frombytes('1', size, bytes(blackbuffer)).transpose(Image.Transpose.ROTATE_270)
+        ry = Image.frombytes('1', size, bytes(rybuffer)).transpose(Image.Transpose.ROTATE_270)
+        image = Image.new('RGB', black.size, 'white')
+        image.paste('black', mask=black.point(lambda p: 255 - p))
+        image.paste('red', mask=ry.point(lambda p: 255 - p))
+        return image
+
+
+class SpiTransport:
+    """Connection to the display by SPI and GPIO pins of the Raspberry Pi."""
+    # the kernel buffer of spidev limits the size of a single transfer
+    BUFSIZ_PATH = '/sys/module/spidev/parameters/bufsiz'
+    BUFSIZ_DEFAULT = 4096
+
+    @staticmethod
+    def saved_speed():
+        """Returns the SPI clock found by the calibration if enabled or the configured one."""
+        if not DISPLAY_SPI_USE_CALIBRATION:
+            return DISPLAY_SPI_SPEED
+        try:
+            with open(os.path.join(STATE_DIR, DISPLAY_SPI_SPEED_FILE)) as f:
+                return int(json.load(f)['speed_hz'])
+        except (OSError, ValueError, KeyError):
+            return DISPLAY_SPI_SPEED
+
+    def open(self):
+        import spidev
+        import gpiozero
+        self.GPIO_RST_PIN = gpiozero.LED("GPIO17")
+        self.GPIO_DC_PIN = gpiozero.LED("GPIO25")
+        self.GPIO_BUSY_PIN = gpiozero.Button("GPIO24", pull_up = False)
+        self.spi = spidev.SpiDev()
+        self.spi.open(0, 0)
+        self.spi.max_speed_hz = SpiTransport.saved_speed()
+        self.spi.mode = 0
+        try:
+            with open(SpiTransport.BUFSIZ_PATH) as f:
+                self.chunk_size = int(f.read())
+        except (OSError, ValueError):
+            self.chunk_size = SpiTransport.BUFSIZ_DEFAULT
+
+    def close(self):
+        self.spi.close()
+        self.GPIO_RST_PIN.off()
+        self.GPIO_DC_PIN.off()
+        del self.spi
+        del self.GPIO_RST_PIN
+        del self.GPIO_DC_PIN
+        del self.GPIO_BUSY_PIN
+
+    def set_pin_rst(self, value):
+        self.GPIO_RST_PIN.on() if value else self.GPIO_RST_PIN.off()
+
+    def set_pin_dc(self, value):
+        self.GPIO_DC_PIN.on() if value else self.GPIO_DC_PIN.off()
+
+    def get_pin_busy(self):
+        return self.GPIO_BUSY_PIN.value
+
+    def wait_pin_busy(self, timeout):
+        return self.GPIO_BUSY_PIN.wait_for_press(timeout)
+
+    def set_speed(self, speed_hz):
+        self.spi.max_speed_hz = speed_hz
+
+    def writebytes(self, data):
+        self.spi.writebytes(data)
+
+    def writebytes2(self, data):
+        """Writes a buffer in chunks fitting into the spidev buffer, without copying it."""
+        data = memoryview(data)
+        for offset in range(0, len(data), self.chunk_size):
+            self.spi.writebytes2(data[offset:offset + self.chunk_size])
+
+    def delay(self, seconds):
+        time.sleep(seconds)
+
+
+class VirtualTransport:
+    """
+    Simulated display for running without hardware. The command stream is
+    decoded into the display RAM and every refresh rebuilds the shown image,
+    which is also saved to image_path if given. The busy pin is low for the
+    typical duration of each operation, scaled by time_scale. All delays are
+    added to busy_time, so the modeled display time is known even if
+    time_scale is 0. The time needed by SPI transfers at the set clock is
+    added to transfer_time, and clocks above MAX_SPEED_HZ corrupt all
+    transfers.
+    """
+    BUSY_TIMES = {
+        Display.EPD_CMD_POWER_ON: 0.08,
+        Display.EPD_CMD_POWER_OFF: 0.02,
+        Display.EPD_CMD_DISPLAY_REFRESH: 15.0,
+    }
+    PARTIAL_REFRESH_TIME = 6.0
+    MAX_SPEED_HZ = 8_000_000
+
+    def __init__(self, time_scale=1.0, image_path=None, speed_hz=DISPLAY_SPI_SPEED):
+        self.time_scale = time_scale
+        self.image_path = image_path
+        self.speed_hz = speed_hz
+        self.transfer_time = 0
+        self.black_ram = bytearray(Display.BUFFER_WHITE)
+        self.ry_ram = bytearray(Display.BUFFER_WHITE)
+        self.image = None
+        self.dc = 0
+        self.command = None
+        self.params = []
+        self.partial = False
+        self.window = None
+        self.ram_index = 0
+        self.sleeping = False
+        self.busy_until = 0
+        self.busy_time = 0
+        self.bytes_sent = 0
+        self.commands = collections.Counter()
+        self.refreshes = 0
+        self.partial_refreshes = 0
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def set_pin_rst(self, value):
+        if not value:
+            self.sleeping = False
+            self.partial = False
+
+    def set_pin_dc(self, value):
+        self.dc = value
+
+    def get_pin_busy(self):
+        return 0 if time.monotonic() < self.busy_until else 1
+
+    def wait_pin_busy(self, timeout):
+        remaining = self.busy_until - time.monotonic()
+        time.sleep(max(min(remaining, timeout), 0))
+        return self.get_pin_busy() == 1
+
+    def delay(self, seconds):
+        self.busy_time += seconds
+        time.sleep(seconds * self.time_scale)
+
+    def _set_busy(self, seconds):
+        self.busy_time += seconds
+        self.busy_until = time.monotonic() + seconds * self.time_scale
+
+    def writebytes(self, data):
+        self.writebytes2(data)
+
+    def set_speed(self, speed_hz):
+        self.speed_hz = speed_hz
+
+    def writebytes2(self, data):
+        self.bytes_sent += len(data)
+        self.transfer_time += len(data) * 8 / self.speed_hz
+        if self.sleeping or self.speed_hz > VirtualTransport.MAX_SPEED_HZ:
+            return
+        if self.dc:
+            self._data(data)
+        else:
+            for command in data:
+                self._command(command)
+
+    def _window_offsets(self):
+        """Returns the RAM offsets written by display data, in order."""
+        if not self.partial or not self.window:
+            return range(Display.BUFFER_SIZE)
+        h_start, h_end, v_start, v_end = self.window
+        row_size = Display.HEIGHT // 8
+        return [v * row_size + h for v in range(v_start, v_end + 1) for h in range(h_start // 8, h_end // 8 + 1)]
+
+    def _command(self, command):
+        self.commands[command] += 1
+        self.command = command
+        self.params = []
+        if command in (Display.EPD_CMD_DISPLAY_START_BW, Display.EPD_CMD_DISPLAY_START_R):
+            self.ram_index = 0
+            self.offsets = self._window_offsets()
+        elif command == Display.EPD_CMD_PARTIAL_IN:
+            self.partial = True
+        elif command == Display.EPD_CMD_PARTIAL_OUT:
+            self.partial = False
+        elif command == Display.EPD_CMD_DISPLAY_REFRESH:
+            self._refresh()
+        elif command in VirtualTransport.BUSY_TIMES:
+            self._set_busy(VirtualTransport.BUSY_TIMES[command])
+
+    def _data(self, data):
+        if self.command in (Display.EPD_CMD_DISPLAY_START_BW, Display.EPD_CMD_DISPLAY_START_R):
+            ram = self.black_ram if self.command == Display.EPD_CMD_DISPLAY_START_BW else self.ry_ram
+            for value in data:
+                if self.ram_index < len(self.offsets):
+                    ram[self.offsets[self.ram_index]] = value
+                self.ram_index += 1
+            return
+        self.params += list(data)
+        if self.command == Display.EPD_CMD_PARTIAL_WINDOW and len(self.params) == 7:
+            p = self.params
+            self.window = (p[0] & 0xf8, p[1] | 0x07, (p[2] << 8) | p[3], (p[4] << 8) | p[5])
+        elif self.command == Display.EPD_CMD_DEEP_SLEEP and self.params == [Display.EPD_PARAM_DEEP_SLEEP_CHECK_CODE]:
+            self.sleeping = True
+
+    def _refresh(self):
+        self.refreshes += 1
+        if self.partial:
+            self.partial_refreshes += 1
+            self._set_busy(VirtualTransport.PARTIAL_REFRESH_TIME)
+        else:
+            self._set_busy(VirtualTransport.BUSY_TIMES[Display.EPD_CMD_DISPLAY_REFRESH])
+        self.image = Display.buffers_to_image(self.black_ram, self.ry_ram)
+        if self.image_path:
+            self.image.save(self.image_path)
+
+
+class AsyncDisplay:
+    """
+    Display frontend that refreshes the display in a worker thread, so that
+    reading and rendering the next frame overlaps with the slow refresh.
+
+    Frames wait in a queue holding a single frame. A newer frame replaces a
+    waiting older one, since only the latest frame is worth showing.
+    """
+    WIDTH = Display.WIDTH
+    HEIGHT = Display.HEIGHT
+
+    def __init__(self, display):
+        self.target = display
+        self.condition = threading.Condition()
+        self.pending = None
+        self.running = False
+
+    def __enter__(self):
+        self.running = True
+        self.worker = threading.Thread(target=self._run, name='helios-display', daemon=True)
+        self.worker.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.worker.join()
+        return False
+
+    def display(self, blackimage, ryimage, force=False, region=None):
+        """Queues a frame with the same arguments as Display.display()."""
+        with self.condition:
+            if self.pending:
+                # the replaced frame was never shown, so its changes have to be refreshed as well
+                METRICS.inc('helios_display_frames_replaced_total')
+                old_region = self.pending[3]
+                if region and old_region:
+                    region = (min(region[0], old_region[0]), min(region[1], old_region[1]), max(region[2], old_region[2]), max(region[3], old_region[3]))
+                else:
+                    region = None
+                if ryimage is None:
+                    ryimage = self.pending[1]
+                force = force or self.pending[2]
+            self.pending = (blackimage, ryimage, force, region)
+            self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or not self.running)
+                if not self.pending:
+                    return
+                frame, self.pending = self.pending, None
+            try:
+                blackimage, ryimage, force, region = frame
+                self.target.display(blackimage, ryimage, force=force, region=region)
+            except Exception as e:
+                print(f'Error refreshing display: {e!r}')
+
+
+class FrameServer:
+    """
+    Display frontend that keeps the latest frame and serves it to any number
+    of clients over HTTP, before passing it on to the target display.
+
+    Each frame is packed and encoded once. Clients sending the ETag of the
+    frame they have in If-None-Match get a 304 response until it changes.
+    Served are /frame.png and /frame.bin with the packed black and red
+    buffers of the display. The latter also carries the changed region in
+    X-Helios-Region, valid for the frame with X-Helios-Previous-ETag. The
+    page at / shows the frame in a browser and reloads it every SAMPLE_TIME.
+    """
+    WIDTH = Display.WIDTH
+    HEIGHT = Display.HEIGHT
+    PAGE = ('<!DOCTYPE html><html><head><title>Helios Power Gauge</title><meta http-equiv="refresh" content="{refresh}"></head>'
+            '<body style="margin:0"><img src="frame.png" alt="Helios Power Gauge" style="width:100%;image-rendering:pixelated"></body></html>')
+
+    def __init__(self, target=None):
+        self.target = target
+        self.lock = threading.Lock()
+        self.ry_buffer = Display.BUFFER_WHITE
+        self.etag = None
+        self.previous_etag = None
+        self.region = None
+        # path -> (content type, body)
+        self.files = {}
+
+    def display(self, blackimage, ryimage, force=False, region=None):
+        """Keeps a frame with the same arguments as Display.display() and passes it on."""
+        blackbuffer = bytes(Display._getbuffer(blackimage) if isinstance(blackimage, Image.Image) else blackimage)
+        if ryimage is not None:
+            ryimage = bytes(Display._getbuffer(ryimage) if isinstance(ryimage, Image.Image) else ryimage)
+        with self.lock:
+            rybuffer = self.ry_buffer if ryimage is None else ryimage
+            etag = f'{zlib.crc32(blackbuffer + rybuffer):08x}'
+            if etag != self.etag:
+                png = io.BytesIO()
+                Display.buffers_to_image(blackbuffer, rybuffer).save(png, 'PNG')
+                self.files = {
+                    '/frame.png': ('image/png', png.getvalue()),
+                    '/frame.bin': ('application/octet-stream', blackbuffer + rybuffer),
+                }
+                self.previous_etag = self.etag
+                self.etag = etag
+                self.region = None if force else region
+                self.ry_buffer = rybuffer
+        if self.target:
+            self.target.display(blackbuffer, ryimage, force=force, region=region)
+
+    def _response(self, path, if_none_match):
+        """Returns status, headers and body of the response to a request."""
+        if path == '/':
+            return 200, {'Content-Type': 'text/html; charset=utf-8'}, FrameServer.PAGE.format(refresh=SAMPLE_TIME).encode()
+        with self.lock:
+            if path not in ('/frame.png', '/frame.bin'):
+                return 404, {}, b''
+            if path not in self.files:
+                return 503, {}, b''
+            content_type, body = self.files[path]
+            etag = f'"{self.etag}-{path[1:]}"'
+            headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+            if path == '/frame.bin' and self.region and self.previous_etag:
+                headers['X-Helios-Region'] = ','.join(str(int(value)) for value in self.region)
+                headers['X-Helios-Previous-ETag'] = f'"{self.previous_etag}-frame.bin"'
+        if if_none_match and (if_none_match.strip() == '*' or etag in (tag.strip() for tag in if_none_match.split(','))):
+            return 304, headers, b''
+        headers['Content-Type'] = content_type
+        return 200, headers, body
+
+    def serve(self, host, port):
+        """Serves the frames in a background thread."""
+        def handle(path, params, headers):
+            status, response_headers, body = self._response(path, headers.get('If-None-Match'))
+            METRICS.inc('helios_frame_requests_total', path=path if status != 404 else 'other', status=status)
+            return status, response_headers, body
+        return serve_http(host, port, handle, 'helios-frames')
+
+
+class FrameClient:
+    """
+    Shows the frames of another Helios on the display, without reading any
+    data itself. Frames are only transferred if they changed and the changed
+    region is refreshed partially whenever the previous frame is shown.
+    """
+    def __init__(self, display, url):
+        self.display = display
+        self.url = url
+        self.etag = None
+
+    def poll(self):
+        """Fetches the frame and shows it if it changed."""
+        request = urllib.request.Request(self.url, headers={'If-None-Match': self.etag} if self.etag else {})
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                body = response.read()
+                headers = response.headers
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return
+            raise HeliosException(f'Error reading frame from {self.url}: {e}')
+        if len(body) != 2 * Display.BUFFER_SIZE:
+            raise HeliosException(f'Invalid frame of {len(body)} bytes from {self.url}')
+        region = None
+        if headers.get('X-Helios-Region') and headers.get('X-Helios-Previous-ETag') == self.etag:
+            region = tuple(int(value) for value in headers['X-Helios-Region'].split(','))
+        self.display.display(body[:Display.BUFFER_SIZE], body[Display.BUFFER_SIZE:], region=region)
+        self.etag = headers.get('ETag')
 
 
 class Designer:
     FONT_PATH = 'arial.ttf'
     RESSOURCE_DIR = os.path.dirname(os.path.realpath(__file__))
+    CAR_PATH = 'car.png'
+    ARROW_MARGIN = 10
+    STALE_MARK = '?'
+    TEXT_CACHE_SIZE = 256
 
     def __init__(self, display):
         self.display = display
         self.font = ImageFont.truetype(os.path.join(Designer.RESSOURCE_DIR, Designer.FONT_PATH), 18)
         self.font_small = ImageFont.truetype(os.path.join(Designer.RESSOURCE_DIR, Designer.FONT_PATH), 11)
+        with Image.open(os.path.join(Designer.RESSOURCE_DIR, Designer.CAR_PATH)) as car:
+            self.car = car.copy()
+        # rendered text bitmaps, kept per instance since they depend on the loaded fonts
+        self._render_text = functools.lru_cache(maxsize=Designer.TEXT_CACHE_SIZE)(self._render_text)
+        # everything not depending on data is drawn only once
+        self.background = self._draw_background()
+        # drawn elements of the current and previous frame as name -> (state, bounding box)
+        self.elements = {}
+        self.last_elements = {}
+
+    def _add_element(self, name, state, *bboxes):
+        """Records the state and bounding box of a drawn element for dirty region tracking."""
+        bboxes = [bbox for bbox in bboxes if bbox]
+        bbox = None
+        if bboxes:
+            bbox = (min(b[0] for b in bboxes), min(b[1] for b in bboxes), max(b[2] for b in bboxes), max(b[3] for b in bboxes))
+        self.elements[name] = (state, bbox)
+
+    def _get_dirty_region(self):
+        """
+        Returns the bounding box of all elements whose state changed since the
+        last frame, or None if the whole frame has to be refreshed.
+        """
+        if not self.last_elements or self.last_elements.keys() != self.elements.keys():
+            return None
+        bboxes = []
+        for name, (state, bbox) in self.elements.items():
+            last_state, last_bbox = self.last_elements[name]
+            if state != last_state:
+                bboxes += [b for b in (bbox, last_bbox) if b]
+        if not bboxes:
+            return None
+        return (min(b[0] for b in bboxes), min(b[1] for b in bboxes), max(b[2] for b in bboxes), max(b[3] for b in bboxes))
+
+    def _render_text(self, text, font, anchor):
+        """Renders text to a mask and returns it with its offset to the anchor point."""
+        left, top, right, bottom = self.draw.textbbox((0, 0), text, font=font, anchor=anchor)
+        mask = Image.new(mode='1', size=(right - left, bottom - top), color=0)
+        ImageDraw.Draw(mask).text((-left, -top), text, font=font, fill=1, anchor=anchor)
+        return mask, (left, top)
+
+    def _draw_text(self, coord, text, font, anchor=None):
+        """Draws text from the text cache at a whole pixel position and returns its bounding box."""
+        mask, (left, top) = self._render_text(text, font, anchor)
+        x, y = int(coord[0]) + left, int(coord[1]) + top
+        self.image_buffer.paste(0, (x, y), mask)
+        return (x, y, x + mask.width, y + mask.height)
+
+    def _draw_background(self):
+        self.image_buffer = Image.new(mode='1', size=(self.display.WIDTH, self.display.HEIGHT), color=1)
+        self.draw = ImageDraw.Draw(self.image_buffer)
+        self._draw_battery_outline()
+        self._draw_house_outline()
+        return self.image_buffer
 
-    def _draw_battery(self, state):
+    def _new_frame(self):
+        return self.background.copy()
+
+    def _draw_battery_outline(self):
         self.draw.rectangle((1+5, 15, 29-5, 20), fill=1, outline=0)
         self.draw.rectangle((1, 20, 29, 102), fill=1, outline=0)
+
+    def _draw_battery(self, state, stale=False):
         self.draw.rectangle((3, 22+2*0+14*0, 27, 22+2*0+14*1), fill=0 if state > 90 else 1, outline=0)
         self.draw.rectangle((3, 22+2*1+14*1, 27, 22+2*1+14*2), fill=0 if state > 70 else 1, outline=0)
         self.draw.rectangle((3, 22+2*2+14*2, 27, 22+2*2+14*3), fill=0 if state > 50 else 1, outline=0)
         self.draw.rectangle((3, 22+2*3+14*3, 27, 22+2*3+14*4), fill=0 if state > 30 else 1, outline=0)
         self.draw.rectangle((3, 22+2*4+14*4, 27, 22+2*4+14*5), fill=0 if state > 10 else 1, outline=0)
-        self.draw.text((5, 105), f'{state:2.0f}%', font=self.font, fill=0)
+        text = f'{state:2.0f}%' + Designer.STALE_MARK * stale
+        bbox = self._draw_text((5, 105), text, self.font)
+        self._add_element('battery', (state, stale), (3, 22, 27, 100), bbox)
 
-    def _draw_house(self, state):
+    def _draw_house_outline(self):
         w = 35
         d = 15
         lt = (self.display.WIDTH/2-w, 60)
@@ -212,7 +1097,6 @@ class Designer:
         lb = (self.display.WIDTH/2-w, 87)
         rb = (self.display.WIDTH/2+w, 87)
         top = (self.display.WIDTH/2, 40)
-        text = (self.display.WIDTH/2, 75)
 
         self.draw.line((lt, lb), fill=0, width=3)
         self.draw.line((lb, rb), fill=0, width=3)
@@ -228,20 +1112,25 @@ class Designer:
         temp_y = rt[1] + d * math.sin(math.radians(base_turn))
         self.draw.line(((temp_x, temp_y), (top[0], top[1])), fill=0, width=3)
 
-        self.draw.text(text, f'{format_measurement(state, "W")}', font=self.font, fill=0, anchor='mm')
+    def _draw_house(self, state, stale=False):
+        label = f'{format_measurement(state, "W")}' + Designer.STALE_MARK * stale
+        bbox = self._draw_text((self.display.WIDTH/2, 75), label, self.font, anchor='mm')
+        self._add_element('house', label, bbox)
 
     def _draw_car(self, type_str):
+        bboxes = []
         if type_str:
-            self.image_buffer.paste(Image.open('car.png'), (250, 45))
-            self.draw.text((252, 15), type_str, font=self.font_small, fill=0)
-
-    def _draw_arrow(self, coord0, coord1, invert=False, draw_head=True):
+            self.image_buffer.paste(self.car, (250, 45))
+            bboxes = [(250, 45, 250 + self.car.width, 45 + self.car.height), self._draw_text((252, 15), type_str, self.font_small)]
+        self._add_element('car', type_str, *bboxes)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _arrow_geometry(coord0, coord1):
+        """Returns the end of the arrow line and the corners of the arrow head."""
         d = 15
         angle = 35
 
-        if invert:
-            coord1, coord0 = coord0, coord1
-
         base_turn = math.degrees(math.atan2(coord1[1] - coord0[1], coord1[0] - coord0[0]))
         x1_back = coord1[0] + (d*0.8) * math.cos(math.radians(base_turn + 180))
         y1_back = coord1[1] + (d*0.8) * math.sin(math.radians(base_turn + 180))
@@ -249,97 +1138,407 @@ class Designer:
         y1_top = coord1[1] + d * math.sin(math.radians(base_turn + 180 + angle))
         x1_bot = coord1[0] + d * math.cos(math.radians(base_turn + 180 - angle))
         y1_bot = coord1[1] + d * math.sin(math.radians(base_turn + 180 - angle))
+        return (x1_back, y1_back), ((coord1[0], coord1[1]), (x1_top, y1_top), (x1_bot, y1_bot))
+
+    def _draw_arrow(self, coord0, coord1, invert=False, draw_head=True):
+        """Draws an arrow and returns its bounding box."""
+        if invert:
+            coord1, coord0 = coord0, coord1
 
         if draw_head:
-            self.draw.line(((coord0[0], coord0[1]), (x1_back, y1_back)), fill=0, width=3)
-            self.draw.polygon(((coord1[0], coord1[1]), (x1_top, y1_top), (x1_bot, y1_bot)), fill=0, outline=0)
+            back, head = Designer._arrow_geometry(tuple(coord0), tuple(coord1))
+            self.draw.line(((coord0[0], coord0[1]), back), fill=0, width=3)
+            self.draw.polygon(head, fill=0, outline=0)
         else:
             self.draw.line(((coord0[0], coord0[1]), (coord1[0], coord1[1])), fill=0, width=3)
 
+        m = Designer.ARROW_MARGIN
+        return (min(coord0[0], coord1[0]) - m, min(coord0[1], coord1[1]) - m, max(coord0[0], coord1[0]) + m, max(coord0[1], coord1[1]) + m)
+
     def _draw_timestamp(self):
-        self.draw.text((296, 128), f'{datetime.datetime.now().strftime("%d.%m.%y %H:%M")}', font=self.font_small, anchor='rb', fill=0)
+        text = f'{datetime.datetime.now().strftime("%d.%m.%y %H:%M")}'
+        bbox = self._draw_text((296, 128), text, self.font_small, anchor='rb')
+        self._add_element('timestamp', text, bbox)
+
+    def _draw_label(self, name, coord, value, stale=False):
+        text = f'{format_measurement(value, "W")}' + Designer.STALE_MARK * stale if value else ''
+        self._add_element(name, text, self._draw_text(coord, text, self.font) if text else None)
 
-    def _draw_labels(self, p_bat, p_pv, p_grid, p_car):
-        if p_bat: self.draw.text((40, 75), f'{format_measurement(p_bat, "W")}', font=self.font, fill=0)
-        if p_pv: self.draw.text((157, 2), f'{format_measurement(p_pv, "W")}', font=self.font, fill=0)
-        if p_grid: self.draw.text((157, 108), f'{format_measurement(p_grid, "W")}', font=self.font, fill=0)
-        if p_car: self.draw.text((193, 75), f'{format_measurement(p_car, "W")}', font=self.font, fill=0)
+    def _draw_labels(self, p_bat, p_pv, p_grid, p_car, stale=()):
+        self._draw_label('label_battery', (40, 75), p_bat, 'battery' in stale)
+        self._draw_label('label_pv', (157, 2), p_pv, 'pv' in stale)
+        self._draw_label('label_grid', (157, 108), p_grid, 'grid' in stale)
+        self._draw_label('label_car', (193, 75), p_car, 'car' in stale)
 
     def draw_data(self, data):
         if VERBOSE:
             print(data)
 
-        self.image_buffer = Image.new(mode='1', size=(self.display.WIDTH, self.display.HEIGHT), color=1)
+        with METRICS.timer('helios_stage_seconds', stage='render'):
+            self._render(data)
+
+        if VERBOSE:
+            self.image_buffer.save('helios_output.png')
+
+        self.display.display(self.image_buffer, None, region=self._get_dirty_region())
+
+    def _render(self, data):
+        self.image_buffer = self._new_frame()
         self.draw = ImageDraw.Draw(self.image_buffer)
+        self.last_elements, self.elements = self.elements, {}
 
-        self._draw_battery(data.battery_charge_level)
-        self._draw_house(data.power_use) # includes data.active_poper from charging station
+        self._draw_battery(data.battery_charge_level, data.is_stale('battery_charge_level'))
+        self._draw_house(data.power_use, data.is_stale('power_use')) # includes data.active_poper from charging station
 
         # set car name to be displayed depending on RFID data
         car_name = WALLBOX_RFID_CARDS.get(data.rfid_card, '')
         self._draw_car(car_name)
 
         # switch arrow direction to battery depending on charging status
+        bbox = None
         if data.battery_charge_status == 'Discharging':
-            self._draw_arrow((35, 64), (90, 64))
+            bbox = self._draw_arrow((35, 64), (90, 64))
         elif data.battery_charge_status == 'Charging':
-            self._draw_arrow((90, 64), (35, 64))
+            bbox = self._draw_arrow((90, 64), (35, 64))
         elif data.battery_charge_status == 'Idle':
             # do not draw arrow if battery is neither charging nor discharging
             pass
+        self._add_element('arrow_battery', bbox and data.battery_charge_status, bbox)
 
         # draw arrow from PV only when energy is supplied
+        bbox = None
         if data.power_from_pv:
-            self._draw_arrow((self.display.WIDTH/2, 4), (self.display.WIDTH/2, 35))
+            bbox = self._draw_arrow((self.display.WIDTH/2, 4), (self.display.WIDTH/2, 35))
+        self._add_element('arrow_pv', bool(bbox), bbox)
 
         # draw arrow to charging station only when car is charging
+        bbox = None
         if data.charging_status == 3:
-            self._draw_arrow((205, 64), (245, 64))
+            bbox = self._draw_arrow((205, 64), (245, 64))
+        self._add_element('arrow_car', bool(bbox), bbox)
 
         # check whether grid is supplying power or energy is fed back into the grid
         if data.power_from_grid - data.power_feed_in > 0:
-            self._draw_arrow((self.display.WIDTH/2, 124), (self.display.WIDTH/2, 95))
+            bbox = self._draw_arrow((self.display.WIDTH/2, 124), (self.display.WIDTH/2, 95))
             grid_power_flow = data.power_from_grid - data.power_feed_in
+            self._add_element('arrow_grid', 'Purchased', bbox)
         else:
-            self._draw_arrow((self.display.WIDTH/2, 95), (self.display.WIDTH/2, 124))
+            bbox = self._draw_arrow((self.display.WIDTH/2, 95), (self.display.WIDTH/2, 124))
             grid_power_flow = data.power_feed_in - data.power_from_grid
+            self._add_element('arrow_grid', 'FeedIn', bbox)
 
-        self._draw_labels(data.battery_charge_power, data.power_from_pv, grid_power_flow, data.active_power)
+        # values which could not be read in time are marked as stale
+        stale = [label for label, fields in (('battery', ('battery_charge_power',)),
+                                             ('pv', ('power_from_pv',)),
+                                             ('grid', ('power_from_grid', 'power_feed_in')),
+                                             ('car', ('active_power',))) if data.is_stale(*fields)]
+        self._draw_labels(data.battery_charge_power, data.power_from_pv, grid_power_flow, data.active_power, stale)
 
         self._draw_timestamp()
 
-        if VERBOSE:
-            self.image_buffer.save('helios_output.png')
-
-        self.display.display(self.image_buffer, None)
-
 
 class ModbusConnection:
     """
-    Context manager for Modbus connection
+    Long-lived Modbus connection to one device, shared between all polls.
 
-    Stolen from: https://gist.github.com/wcheek/35599f2db14592129c358f3b35988d16
+    Use ModbusConnection.get() to get the connection for a host and port and
+    use it as context manager to get the connected client. Requests to the
+    same device are serialized. A broken connection is closed and reopened on
+    the next use, with an increasing backoff between failed connects. A
+    connection the device closed in the meantime is detected before use.
+
+    Originally stolen from: https://gist.github.com/wcheek/35599f2db14592129c358f3b35988d16
     """
+    BACKOFF_MIN = 1
+    BACKOFF_MAX = 60
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    connections = {}
+    connections_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, host, port):
+        with cls.connections_lock:
+            if (host, port) not in cls.connections:
+                cls.connections[(host, port)] = cls(host, port)
+            return cls.connections[(host, port)]
+
     def __init__(self, host, port):
         self.host = host
         self.port = port
         self.client = None
+        self.lock = threading.Lock()
+        self.backoff = 0
+        self.next_connect = 0
+        self.connects = 0
+        self.reconnects = 0
+        self.errors = 0
+        self.latency = Histogram(ModbusConnection.LATENCY_BUCKETS)
+
+    def _connect(self):
+        if time.monotonic() < self.next_connect:
+            raise HeliosException(f'Waiting {self.backoff} s before reconnecting to {self.host}:{self.port}')
+        if self.connects:
+            self.reconnects += 1
+        self.connects += 1
+        # only imported when Modbus is used, to speed up the start
+        from pymodbus.client import ModbusTcpClient
+        self.client = ModbusTcpClient(host=self.host, port=self.port)
+        if not self.client.connect():
+            self._close()
+            self.backoff = min(max(self.backoff * 2, ModbusConnection.BACKOFF_MIN), ModbusConnection.BACKOFF_MAX)
+            self.next_connect = time.monotonic() + self.backoff
+            raise HeliosException(f'Could not connect to {self.host}:{self.port}')
+        self.backoff = 0
+
+    def _close(self):
+        if self.client:
+            self.client.close()
+        self.client = None
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _is_open(self):
+        """Checks without a request that the device has not closed the connection."""
+        if self.client is None or not self.client.connected:
+            return False
+        # between requests nothing is to be read, unless the device closed the connection or a late response is pending
+        try:
+            readable, _, _ = select.select([self.client.socket], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
 
     def __enter__(self):
-        self.client = ModbusTcpClient(host=self.host, port=self.port)
-        self.client.connect()
+        self.lock.acquire()
+        try:
+            if not self._is_open():
+                self._close()
+                self._connect()
+        except BaseException:
+            self.errors += 1
+            self.lock.release()
+            raise
+        self.start = time.perf_counter()
         return self.client
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.client:
-            self.client.close()
+        self.latency.observe(time.perf_counter() - self.start)
+        if exc_type:
+            # do not trust the connection anymore after any error
+            self.errors += 1
+            self._close()
+        self.lock.release()
         return False
 
+    def __str__(self):
+        return f'{self.host}:{self.port}: {self.connects} connects, {self.reconnects} reconnects, {self.errors} errors, latency {self.latency}'
+
 
 class HeliosException(Exception):
     """Custom exception for Helios Power Gauge."""
 
 
+class RegistersRejectedException(HeliosException):
+    """The device answered a read with a Modbus exception, e.g. for registers it does not have."""
+
+
+@METRICS.collector
+def collect_modbus_metrics():
+    for connection in list(ModbusConnection.connections.values()):
+        labels = {'device': f'{connection.host}:{connection.port}'}
+        yield 'helios_modbus_connects_total', labels, connection.connects
+        yield 'helios_modbus_reconnects_total', labels, connection.reconnects
+        yield 'helios_modbus_errors_total', labels, connection.errors
+        yield 'helios_modbus_request_seconds', labels, connection.latency
+
+
+Register = collections.namedtuple('Register', ['name', 'address', 'type', 'scale', 'word_order'], defaults=[0, 'big'])
+Register.__doc__ = """
+Description of a value in holding registers. The scale is either a power
+of ten or the name of the register holding a SunSpec scale factor.
+"""
+
+
+class RegisterMap:
+    """
+    Declarative map of all registers read from a device. Nearby registers
+    are merged into as few block reads as the device allows and all values
+    are decoded from the read registers in one pass.
+    """
+    TYPES = {
+        'uint16': ('H', 1),
+        'int16': ('h', 1),
+        'uint32': ('I', 2),
+        'int32': ('i', 2),
+        'sunssf': ('h', 1),
+        'float32': ('f', 2),
+    }
+    # SunSpec value of a scale factor that is not implemented
+    SUNSSF_NOT_IMPLEMENTED = -0x8000
+
+    def __init__(self, registers, max_count=125, max_gap=32):
+        self.registers = sorted(registers, key=lambda register: register.address)
+        self.max_count = max_count
+        self.max_gap = max_gap
+        self.blocks = self._plan()
+
+    def _plan(self):
+        """Returns the block reads as list of (start address, register count, registers)."""
+        blocks = []
+        for register in self.registers:
+            size = RegisterMap.TYPES[register.type][1]
+            if blocks:
+                start, count, registers = blocks[-1]
+                end = register.address + size
+                if register.address - (start + count) <= self.max_gap and end - start <= self.max_count:
+                    blocks[-1] = (start, max(count, end - start), registers + [register])
+                    continue
+            blocks.append((register.address, size, [register]))
+        return blocks
+
+    def _decode(self, start, words, registers, values):
+        data = struct.pack(f'>{len(words)}H', *words)
+        for register in registers:
+            fmt, size = RegisterMap.TYPES[register.type]
+            offset = (register.address - start) * 2
+            raw = data[offset:offset + size * 2]
+            if register.word_order == 'little':
+                raw = b''.join(raw[i:i + 2] for i in reversed(range(0, len(raw), 2)))
+            values[register.name] = struct.unpack('>' + fmt, raw)[0]
+
+    def read(self, client):
+        """Reads and decodes all registers and returns the values by name."""
+        values = {}
+        for start, count, registers in self.blocks:
+            result = client.read_holding_registers(address=start, count=count)
+            if result.isError():
+                # only an exception response of the device has an exception code, unlike a missing response
+                exception = RegistersRejectedException if hasattr(result, 'exception_code') else HeliosException
+                raise exception(f'Error reading registers {start}-{start + count - 1}: {result}')
+            self._decode(start, result.registers, registers, values)
+        for register in self.registers:
+            scale = values[register.scale] if isinstance(register.scale, str) else register.scale
+            if scale == RegisterMap.SUNSSF_NOT_IMPLEMENTED:
+                values[register.name] = 0
+            elif scale > 0:
+                values[register.name] *= 10 ** scale
+            elif scale < 0:
+                values[register.name] /= 10 ** -scale
+        return values
+
+
+# Modbus addresses for wallbox: https://www.keba.com/download/x/dea7ae6b84/kecontactp30modbustcp_pgen.pdf
+# the registers are read one by one, as long as it is not confirmed that a P30 answers reads spanning undocumented registers
+WALLBOX_REGISTERS = RegisterMap([
+    Register('charging_status', 1000, 'uint32'),
+    # active power in milliwatts, scaled to watts
+    Register('active_power', 1020, 'uint32', -3),
+    # total energy consumption in 0.1 watt-hours, scaled to kilowatt-hours
+    Register('total_energy', 1036, 'uint32', -4),
+    Register('rfid_card', 1500, 'uint32'),
+    # transferred energy of the current session in 0.1 watt-hours, scaled to kilowatt-hours
+    #Register('charged_energy', 1502, 'uint32', -4),
+], max_gap=0)
+
+class SunSpecDevice:
+    """
+    Converter with SunSpec models, which are found by walking the model
+    chain once. The registers of the inverter model, the first meter model
+    and the first battery are then read in a few block reads. The models
+    are only discovered again if the device rejects a read, not on I/O
+    errors. A converter rejecting the battery registers has no battery and
+    its values are reported as 0 and 'Unknown'.
+
+    References:
+     - https://knowledge-center.solaredge.com/sites/kc/files/sunspec-implementation-technical-note.pdf
+     - https://knowledge-center.solaredge.com/sites/kc/files/solaredge-storedge-modbus-tn.pdf
+    """
+    BASE_ADDRESS = 40000
+    MARKER = b'SunS'
+    END_MODEL = 0xffff
+    INVERTER_MODELS = (101, 102, 103)
+    METER_MODELS = (201, 202, 203, 204)
+    # registers of battery 1, whose floats have little-endian word order
+    BATTERY_REGISTERS = RegisterMap([
+        # positive if charging
+        Register('battery_power', 0xE174, 'float32', 0, 'little'),
+        Register('battery_state_of_energy', 0xE184, 'float32', 0, 'little'),
+        Register('battery_status', 0xE186, 'uint32', 0, 'little'),
+    ])
+    BATTERY_STATUS = {3: 'Charging', 4: 'Discharging', 7: 'Idle'}
+    NO_BATTERY = {'battery_power': 0, 'battery_state_of_energy': 0, 'battery_status': 0}
+
+    devices = {}
+
+    @classmethod
+    def get(cls, host, port):
+        if (host, port) not in cls.devices:
+            cls.devices[(host, port)] = cls(ModbusConnection.get(host, port))
+        return cls.devices[(host, port)]
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.registers = None
+        # whether the converter has a battery, None until known
+        self.battery = None
+
+    def _discover(self, client):
+        """Returns the start address of the data of each model by model id."""
+        result = client.read_holding_registers(address=SunSpecDevice.BASE_ADDRESS, count=2)
+        if result.isError() or struct.pack('>2H', *result.registers) != SunSpecDevice.MARKER:
+            raise HeliosException(f'No SunSpec device at {self.connection.host}:{self.connection.port}')
+        models = {}
+        address = SunSpecDevice.BASE_ADDRESS + 2
+        while True:
+            result = client.read_holding_registers(address=address, count=2)
+            if result.isError():
+                raise HeliosException(f'Error reading SunSpec model header at {address}: {result}')
+            model_id, length = result.registers
+            if model_id == SunSpecDevice.END_MODEL:
+                return models
+            models.setdefault(model_id, address + 2)
+            address += 2 + length
+
+    def _register_map(self, models):
+        inverter = next((models[model] for model in SunSpecDevice.INVERTER_MODELS if model in models), None)
+        meter = next((models[model] for model in SunSpecDevice.METER_MODELS if model in models), None)
+        if inverter is None or meter is None:
+            raise HeliosException(f'No inverter or meter model found in SunSpec models {sorted(models)}')
+        return RegisterMap([
+            Register('ac_power', inverter + 12, 'int16', 'ac_power_sf'),
+            Register('ac_power_sf', inverter + 13, 'sunssf'),
+            # total real power of all phases, positive if exported to the grid
+            Register('meter_power', meter + 16, 'int16', 'meter_power_sf'),
+            Register('meter_power_sf', meter + 20, 'sunssf'),
+        ])
+
+    def read(self):
+        """Reads and decodes the registers of all models and returns the values by name."""
+        with self.connection as client:
+            if self.registers is None:
+                self.registers = self._register_map(self._discover(client))
+            try:
+                values = self.registers.read(client)
+            except RegistersRejectedException:
+                # the models are discovered again, in case the device was replaced or updated
+                self.registers = None
+                raise
+            if self.battery is False:
+                values.update(SunSpecDevice.NO_BATTERY)
+                return values
+            try:
+                values.update(SunSpecDevice.BATTERY_REGISTERS.read(client))
+                self.battery = True
+            except RegistersRejectedException:
+                print(f'No battery found at {self.connection.host}:{self.connection.port}')
+                self.battery = False
+                values.update(SunSpecDevice.NO_BATTERY)
+            return values
+
+
 def read_data_from_charging_station_via_modbus():
     """
     Read all necessary data points from the wallbox by ModbusTCP.
@@ -348,24 +1547,9 @@ def read_data_from_charging_station_via_modbus():
      - Modbus addresses for wallbox:
        https://www.keba.com/download/x/dea7ae6b84/kecontactp30modbustcp_pgen.pdf
     """
-    with ModbusConnection(host=WALLBOX_IP, port=WALLBOX_PORT) as client:
-        # read charging status
-        result = client.read_holding_registers(address=1000, count=1)
-        charging_status = BinaryPayloadDecoder.fromRegisters(result.registers, byteorder=Endian.Big).decode_32bit_uint()
-        # read total energy (register contains the total energy consumption in 0.1 watt-hours)
-        result = client.read_holding_registers(address=1036, count=1)
-        total_energy = BinaryPayloadDecoder.fromRegisters(result.registers, byteorder=Endian.Big).decode_32bit_uint() / 10000
-        # read active power (register contains the active power in milliwatts)
-        result = client.read_holding_registers(address=1020, count=1)
-        active_power = BinaryPayloadDecoder.fromRegisters(result.registers, byteorder=Endian.Big).decode_32bit_uint() / 1000
-        # read RFID card number
-        result = client.read_holding_registers(address=1500, count=1)
-        rfid_card = BinaryPayloadDecoder.fromRegisters(result.registers, byteorder=Endian.Big).decode_32bit_uint()
-        # read charged energy (register contains the transferred energy of the current session in 0.1 watt-hours)
-        #result = client.read_holding_registers(address=1502, count=1)
-        #charged_energy = BinaryPayloadDecoder.fromRegisters(result.registers, byteorder=Endian.BIG).decode_32bit_uint() / 10000
-        #print(f'Charged energy in current session: {charged_energy} kWh')
-    return charging_status, total_energy, active_power, rfid_card
+    with ModbusConnection.get(host=WALLBOX_IP, port=WALLBOX_PORT) as client:
+        values = WALLBOX_REGISTERS.read(client)
+    return values['charging_status'], values['total_energy'], values['active_power'], values['rfid_card']
 
 
 def read_data_from_converter_via_modbus():
@@ -375,83 +1559,272 @@ def read_data_from_converter_via_modbus():
     References:
      - Modbus addresses for inverter:
        https://knowledge-center.solaredge.com/sites/kc/files/sunspec-implementation-technical-note.pdf
-     - Decoding of values with BinaryPayloadDecoder:
-       https://pymodbus.readthedocs.io/en/latest/source/library/pymodbus.html#pymodbus.payload.BinaryPayloadDecoder
-    """
-    with ModbusConnection(host=CONVERTER_IP, port=CONVERTER_PORT) as client:
-        # read current AC power from converter
-        result = client.read_holding_registers(address=40083, count=2)
-        ac_power_used_value = BinaryPayloadDecoder.fromRegisters([result.registers[0]], byteorder=Endian.Big).decode_16bit_int()
-        ac_power_used_scale_factor = BinaryPayloadDecoder.fromRegisters([result.registers[1]], byteorder=Endian.Big).decode_16bit_int()
-        power_use = ac_power_used_value * pow(10, ac_power_used_scale_factor)
-    battery_charge_level = 0
-    battery_charge_status = 'Unknown'
-    battery_charge_power = 0
-    power_from_grid = 0
-    power_from_pv = 0
-    power_self_consumption = 0
-    power_feed_in = 0
+    """
+    values = SunSpecDevice.get(host=CONVERTER_IP, port=CONVERTER_PORT).read()
+    battery_charge_level = values['battery_state_of_energy']
+    battery_charge_status = SunSpecDevice.BATTERY_STATUS.get(values['battery_status'], 'Unknown')
+    battery_charge_power = abs(values['battery_power'])
+    # the battery is DC coupled, so the PV power is split between the AC output and the battery
+    power_from_pv = max(values['ac_power'] + values['battery_power'], 0)
+    power_use = values['ac_power'] - values['meter_power']
+    power_from_grid = max(-values['meter_power'], 0)
+    power_feed_in = max(values['meter_power'], 0)
+    power_self_consumption = power_use - power_from_grid
     return battery_charge_level, battery_charge_status, battery_charge_power, power_use, power_from_grid, power_from_pv, power_self_consumption, power_feed_in
 
 
+class SolarEdgeApi:
+    """
+    Client for the SolarEdge monitoring API that respects the daily request
+    limit.
+
+    Every endpoint is cached for the current polling interval, which spreads
+    the remaining requests of the day over the rest of the day. Daylight
+    hours and fast changing values get more requests. Requests used today are
+    persisted, so restarts do not reset the budget. Once the budget is used
+    up, the cached response is returned until the next day. After a rate
+    limit response, the cached responses are returned for a few polling
+    intervals, doubled with every further rate limit response.
+
+    References:
+     - API documentation:
+       https://www.solaredge.com/sites/default/files/se_monitoring_api.pdf
+       https://developers.solaredge.com/docs/monitoring/e9nwvc91l1jf5-getting-started-with-monitoring-api
+    """
+    ENDPOINTS = ('currentPowerFlow', 'powerDetails')
+    BUDGET_FILE = 'solaredge_budget.json'
+    # polling intervals waited after the first rate limit response and at most
+    RATE_LIMIT_BACKOFF_MIN = 2
+    RATE_LIMIT_BACKOFF_MAX = 16
+
+    clients = {}
+    clients_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, api_key, site_id):
+        with cls.clients_lock:
+            if (api_key, site_id) not in cls.clients:
+                cls.clients[(api_key, site_id)] = cls(api_key, site_id)
+            return cls.clients[(api_key, site_id)]
+
+    def __init__(self, api_key, site_id):
+        self.api_key = api_key
+        self.site_id = site_id
+        # only imported when the API is used, to speed up the start
+        import requests
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        # endpoint -> (time of response, response data)
+        self.cache = {}
+        self.values = {}
+        self.fast_change_until = 0
+        self.backoff = 0
+        self.backoff_until = 0
+        self.budget_file = os.path.join(STATE_DIR, SolarEdgeApi.BUDGET_FILE)
+        self.day = datetime.date.today().isoformat()
+        self.used = 0
+        self.requests = 0
+        self.cache_hits = 0
+        self.rate_limits = 0
+        try:
+            with open(self.budget_file) as f:
+                budget = json.load(f)
+            if budget['day'] == self.day:
+                self.used = budget['used']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _save_budget(self):
+        write_atomically(self.budget_file, json.dumps({'day': self.day, 'used': self.used}))
+
+    def remaining(self):
+        today = datetime.date.today().isoformat()
+        if today != self.day:
+            self.day = today
+            self.used = 0
+        return max(SOLAREDGE_DAILY_LIMIT - self.used, 0)
+
+    def _weight(self, hour):
+        start, end = SOLAREDGE_DAYLIGHT_HOURS
+        return SOLAREDGE_DAYLIGHT_WEIGHT if start <= hour < end else 1
+
+    def interval(self):
+        """
+        Returns the time in seconds until an endpoint may be requested again.
+        The remaining day is weighted by hour, so that every endpoint can be
+        polled evenly with the remaining budget in weighted time.
+        """
+        now = datetime.datetime.now()
+        midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+        weighted_seconds = 0
+        t = now
+        while t < midnight:
+            next_hour = min((t + datetime.timedelta(hours=1)).replace(minute=0, second=0, microsecond=0), midnight)
+            weighted_seconds += (next_hour - t).total_seconds() * self._weight(t.hour)
+            t = next_hour
+        polls = self.remaining() / len(SolarEdgeApi.ENDPOINTS)
+        if polls < 1:
+            return (midnight - now).total_seconds()
+        interval = weighted_seconds / polls / self._weight(now.hour)
+        if time.time() < self.fast_change_until:
+            interval /= 2
+        return max(interval, SOLAREDGE_MIN_INTERVAL)
+
+    def update_values(self, values):
+        """Compares new values with the last ones to poll more often while they change fast."""
+        for name, value in values.items():
+            last = self.values.get(name)
+            if last is not None and abs(value - last) > SOLAREDGE_FAST_CHANGE * max(abs(last), 1):
+                self.fast_change_until = time.time() + 2 * self.interval()
+            self.values[name] = value
+
+    def request(self, endpoint, params=None):
+        """Returns the JSON response of an endpoint, from cache while it is fresh or the budget is used up."""
+        with self.lock:
+            cached = self.cache.get(endpoint)
+            if cached and time.time() - cached[0] < self.interval():
+                self.cache_hits += 1
+                return cached[1]
+            if not self.remaining() or time.time() < self.backoff_until:
+                if cached:
+                    self.cache_hits += 1
+                    return cached[1]
+                raise HeliosException('SolarEdge API request limit reached and no cached data available')
+            self.used += 1
+            self.requests += 1
+            self._save_budget()
+
+        url = f'{SOLAREDGE_API_URL}/site/{self.site_id}/{endpoint}'
+        response = self.session.get(url, params=dict(params or {}, api_key=self.api_key), timeout=5)
+        with self.lock:
+            if response.status_code == 429:
+                # rate limits are often temporary, so back off instead of giving up for the day
+                self.rate_limits += 1
+                self.backoff = min(max(self.backoff * 2, SolarEdgeApi.RATE_LIMIT_BACKOFF_MIN), SolarEdgeApi.RATE_LIMIT_BACKOFF_MAX)
+                self.backoff_until = time.time() + self.backoff * self.interval()
+            elif response.status_code == 200:
+                self.backoff = 0
+        if response.status_code != 200:
+            print(f'Error: {response}')
+            with self.lock:
+                if endpoint in self.cache:
+                    return self.cache[endpoint][1]
+            raise HeliosException('Error reading data from SolarEdge API')
+        data = response.json()
+        with self.lock:
+            self.cache[endpoint] = (time.time(), data)
+        return data
+
+
 def read_power_flow_data_from_api(api_key, site_id):
     """Reads all power flow values from the SolarEdge API."""
-    url = f'https://monitoringapi.solaredge.com/site/{site_id}/currentPowerFlow?api_key={api_key}'
-    response = requests.get(url, timeout=5)
-    if response.status_code != 200:
-        print(f'Error: {response}')
-        raise HeliosException('Error reading data from SolarEdge API')
-    data = response.json()['siteCurrentPowerFlow']
+    api = SolarEdgeApi.get(api_key, site_id)
+    data = api.request('currentPowerFlow')['siteCurrentPowerFlow']
     scaling_factor = 1000 if data['unit'] == 'kW' else 1
     battery_charge_level = data['STORAGE']['chargeLevel']
     battery_charge_status = data['STORAGE']['status']
     battery_charge_power = float(data['STORAGE']['currentPower']) * scaling_factor
+    api.update_values({'battery_charge_power': battery_charge_power})
     return battery_charge_level, battery_charge_status, battery_charge_power
 
 
+@METRICS.collector
+def collect_solaredge_metrics():
+    for api in list(SolarEdgeApi.clients.values()):
+        labels = {'site': api.site_id}
+        yield 'helios_solaredge_requests_total', labels, api.requests
+        yield 'helios_solaredge_cache_hits_total', labels, api.cache_hits
+        yield 'helios_solaredge_rate_limits_total', labels, api.rate_limits
+        yield 'helios_solaredge_budget_used', labels, api.used
+        yield 'helios_solaredge_budget_remaining', labels, api.remaining()
+        yield 'helios_solaredge_poll_interval_seconds', labels, api.interval()
+
+
+class PowerDetailsWindow:
+    """
+    Local window of the quarter-hourly power values of all meters reported
+    by the SolarEdge powerDetails endpoint. Only values newer than the last
+    received ones are requested and merged into the window.
+    """
+    DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+    windows = {}
+
+    @classmethod
+    def get(cls, site_id):
+        if site_id not in cls.windows:
+            cls.windows[site_id] = cls()
+        return cls.windows[site_id]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # meter type -> {date: power in W}, sorted by date
+        self.meters = {}
+
+    def start_time(self, now):
+        """
+        Returns the start of the interval still missing. The last received
+        value is requested again, since it is updated until its quarter of an
+        hour is complete.
+        """
+        window_start = now - datetime.timedelta(seconds=SOLAREDGE_DETAILS_WINDOW)
+        with self.lock:
+            # meters without any value, e.g. a meter type not installed, must not force the whole window again
+            latest = [max(values) for values in self.meters.values() if values]
+            if not latest:
+                return window_start
+            return max(min(latest), window_start)
+
+    def merge(self, data, now):
+        """Adds all values of a powerDetails response and drops values outside of the window."""
+        scaling_factor = 1000 if data['powerDetails']['unit'] == 'kW' else 1
+        window_start = now - datetime.timedelta(seconds=SOLAREDGE_DETAILS_WINDOW)
+        with self.lock:
+            for meter in data['powerDetails']['meters']:
+                values = self.meters.setdefault(meter['type'], {})
+                for entry in meter['values']:
+                    # the current quarter of an hour contains no value yet
+                    if 'value' in entry:
+                        values[datetime.datetime.strptime(entry['date'], PowerDetailsWindow.DATE_FORMAT)] = float(entry['value']) * scaling_factor
+                for date in [date for date in values if date < window_start]:
+                    del values[date]
+                if values:
+                    self.meters[meter['type']] = dict(sorted(values.items()))
+                else:
+                    del self.meters[meter['type']]
+
+    def value(self, meter_type, statistic=None):
+        """Returns the latest, mean or median power of a meter in the window, or 0 if unknown."""
+        with self.lock:
+            values = list(self.meters.get(meter_type, {}).values())
+        if not values:
+            return 0
+        match statistic or SOLAREDGE_DETAILS_STATISTIC:
+            case 'mean': return statistics.fmean(values)
+            case 'median': return statistics.median(values)
+            case _: return values[-1]
+
+
 def read_power_details_data_from_api(api_key, site_id):
     """
-    Reads all power values as median over the last 15 minutes from the
-    SolarEdge API.
+    Reads all power values from the SolarEdge API. Only the values not yet
+    known are requested and each returned value is the statistic configured
+    by SOLAREDGE_DETAILS_STATISTIC over the last SOLAREDGE_DETAILS_WINDOW
+    seconds, by default the latest value.
     """
-    # build URL for API request
+    window = PowerDetailsWindow.get(site_id)
     now = datetime.datetime.now()
-    fifteen_minutes_ago = now - datetime.timedelta(minutes=15)
-    start_time = fifteen_minutes_ago.strftime('%Y-%m-%d %H:%M:%S')
-    end_time = now.strftime('%Y-%m-%d %H:%M:%S')
-    start_time_url = urllib.parse.quote(start_time, safe='/', encoding=None, errors=None)
-    end_time_url = urllib.parse.quote(end_time, safe='/', encoding=None, errors=None)
-    url = f'https://monitoringapi.solaredge.com/site/{site_id}/powerDetails?startTime={start_time_url}&endTime={end_time_url}&api_key={api_key}'
-    response = requests.get(url, timeout=5)
-    if response.status_code != 200:
-        print(f'Error: {response}')
-        raise HeliosException('Error reading data from SolarEdge API')
-    # extract power values from response
-    data = response.json()
-    scaling_factor = 1000 if data['powerDetails']['unit'] == 'kW' else 1
-    power_production_15m = 0
-    power_consumption_15m = 0
-    power_purchased_15m = 0
-    power_self_consumption_15m = 0
-    power_feed_in_15m = 0
-    for meter in data['powerDetails']['meters']:
-        try:
-            # check if last measurement contains no actual value...
-            if 'value' not in meter['values'][-1]:
-                # ...and delete last element if that's true
-                del meter['values'][-1]
-            if meter['type'] == 'Production':
-                power_production_15m = float(meter['values'][-1]['value']) * scaling_factor
-            elif meter['type'] == 'Consumption':
-                power_consumption_15m = float(meter['values'][-1]['value']) * scaling_factor
-            elif meter['type'] == 'SelfConsumption':
-                power_self_consumption_15m = float(meter['values'][-1]['value']) * scaling_factor
-            elif meter['type'] == 'FeedIn':
-                power_feed_in_15m = float(meter['values'][-1]['value']) * scaling_factor
-            elif meter['type'] == 'Purchased':
-                power_purchased_15m = float(meter['values'][-1]['value']) * scaling_factor
-        except KeyError:
-            pass
+    start_time = window.start_time(now).strftime(PowerDetailsWindow.DATE_FORMAT)
+    end_time = now.strftime(PowerDetailsWindow.DATE_FORMAT)
+    api = SolarEdgeApi.get(api_key, site_id)
+    data = api.request('powerDetails', {'startTime': start_time, 'endTime': end_time})
+    window.merge(data, now)
+    power_production_15m = window.value('Production')
+    power_consumption_15m = window.value('Consumption')
+    power_purchased_15m = window.value('Purchased')
+    power_self_consumption_15m = window.value('SelfConsumption')
+    power_feed_in_15m = window.value('FeedIn')
+    api.update_values({'power_consumption': power_consumption_15m, 'power_production': power_production_15m})
     return power_consumption_15m, power_purchased_15m, power_production_15m, power_self_consumption_15m, power_feed_in_15m
 
 
@@ -497,13 +1870,256 @@ def format_measurement(value, unit):
             return f'{value} {unit}'
 
 
-class MeasuringData:
-    def __init__(self, prefer_modbus=False):
-        if prefer_modbus:
-            self.battery_charge_level, self.battery_charge_status, self.battery_charge_power, self.power_use, self.power_from_grid, self.power_from_pv, self.power_self_consumption, self.power_feed_in = read_data_from_converter_via_modbus()
+SourceResult = collections.namedtuple('SourceResult', ['name', 'values', 'timestamp', 'error'])
+SourceResult.__doc__ = """Partial result of a data source. An error is set if the values are not current."""
+
+
+class DataSource:
+    """
+    A data source read concurrently with all others. The source remembers
+    the last values read successfully, which are returned together with the
+    error whenever the source fails or misses its deadline.
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(SOURCE_DEADLINES), thread_name_prefix='helios-source')
+
+    def __init__(self, name, fields, defaults, read_func):
+        self.name = name
+        self.fields = fields
+        self.read_func = read_func
+        self.deadline = SOURCE_DEADLINES[name]
+        self.last_result = SourceResult(name, dict(zip(fields, defaults)), None, HeliosException(f'No data read from {name} yet'))
+        self.future = None
+        self.lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with METRICS.timer('helios_stage_seconds', stage=f'source_{self.name}'):
+                values = dict(zip(self.fields, self.read_func()))
+        except Exception:
+            METRICS.inc('helios_source_errors_total', source=self.name)
+            raise
+        result = SourceResult(self.name, values, time.time(), None)
+        with self.lock:
+            self.last_result = result
+        return result
+
+    def start(self):
+        # a read still running from a previous cycle is reused instead of stacking up further requests
+        if self.future is None or self.future.done():
+            self.future = DataSource.executor.submit(self._read)
+        return self.future
+
+    def result(self, timeout):
+        try:
+            return self.future.result(timeout=max(timeout, 0))
+        except Exception as e:
+            print(f'Error reading data from {self.name}: {e!r}')
+            METRICS.inc('helios_source_stale_total', source=self.name)
+            with self.lock:
+                return self.last_result._replace(error=e)
+
+
+CONVERTER_FIELDS = ('battery_charge_level', 'battery_charge_status', 'battery_charge_power', 'power_use', 'power_from_grid', 'power_from_pv', 'power_self_consumption', 'power_feed_in')
+DATA_SOURCES = {
+    'power_flow': DataSource('power_flow',
+                             CONVERTER_FIELDS[:3], (0, 'Unknown', 0),
+                             lambda: read_power_flow_data_from_api(SOLAREDGE_API_KEY, SOLAREDGE_SITE_ID)),
+    'power_details': DataSource('power_details',
+                                CONVERTER_FIELDS[3:], (0, 0, 0, 0, 0),
+                                lambda: read_power_details_data_from_api(SOLAREDGE_API_KEY, SOLAREDGE_SITE_ID)),
+    'converter': DataSource('converter',
+                            CONVERTER_FIELDS, (0, 'Unknown', 0, 0, 0, 0, 0, 0),
+                            read_data_from_converter_via_modbus),
+    'wallbox': DataSource('wallbox',
+                          ('charging_status', 'total_energy', 'active_power', 'rfid_card'), (1, 0, 0, 0),
+                          read_data_from_charging_station_via_modbus),
+}
+
+
+class RollingAggregate:
+    """
+    Streaming statistics of one field: an EWMA and the mean, median, minimum
+    and maximum of the samples of the last window seconds. The memory used is
+    bounded by max_samples.
+    """
+    def __init__(self, window, ewma_time, max_samples):
+        self.window = window
+        self.ewma_time = ewma_time
+        # (timestamp, value) of all samples in the window, the same values sorted for the median
+        self.samples = collections.deque(maxlen=max_samples)
+        self.sorted = []
+        self.total = 0.0
+        # monotonic queues with the minimum and maximum of the window in front
+        self.min_queue = collections.deque()
+        self.max_queue = collections.deque()
+        self.ewma = None
+        self.last = None
+        self.last_timestamp = None
+
+    def add(self, value, timestamp):
+        if self.ewma is None or self.ewma_time <= 0:
+            self.ewma = value
         else:
-            self.battery_charge_level, self.battery_charge_status, self.battery_charge_power, self.power_use, self.power_from_grid, self.power_from_pv, self.power_self_consumption, self.power_feed_in = read_data_from_converter_via_api()
-        self.charging_status, self.total_energy, self.active_power, self.rfid_card = read_data_from_charging_station_via_modbus()
+            # irregular intervals are weighted by their length
+            self.ewma += (1 - math.exp(-(timestamp - self.last_timestamp) / self.ewma_time)) * (value - self.ewma)
+        self.last = value
+        self.last_timestamp = timestamp
+
+        if len(self.samples) == self.samples.maxlen:
+            self._drop()
+        self.samples.append((timestamp, value))
+        bisect.insort(self.sorted, value)
+        self.total += value
+        while self.min_queue and self.min_queue[-1][1] >= value:
+            self.min_queue.pop()
+        self.min_queue.append((timestamp, value))
+        while self.max_queue and self.max_queue[-1][1] <= value:
+            self.max_queue.pop()
+        self.max_queue.append((timestamp, value))
+        self._expire(timestamp)
+
+    def _drop(self):
+        timestamp, value = self.samples.popleft()
+        del self.sorted[bisect.bisect_left(self.sorted, value)]
+        self.total = self.total - value if self.samples else 0.0
+        if self.min_queue[0][0] == timestamp:
+            self.min_queue.popleft()
+        if self.max_queue[0][0] == timestamp:
+            self.max_queue.popleft()
+
+    def _expire(self, now):
+        # the last sample is kept, so that a statistic is known even after a longer outage
+        while len(self.samples) > 1 and self.samples[0][0] <= now - self.window:
+            self._drop()
+
+    def value(self, statistic=None):
+        """Returns the EWMA or a statistic of the window, or None if no sample was added yet."""
+        if not self.samples:
+            return None
+        match statistic or SAMPLER_STATISTIC:
+            case 'ewma': return self.ewma
+            case 'mean': return self.total / len(self.samples)
+            case 'median':
+                middle = len(self.sorted) // 2
+                return self.sorted[middle] if len(self.sorted) % 2 else (self.sorted[middle - 1] + self.sorted[middle]) / 2
+            case 'min': return self.min_queue[0][1]
+            case 'max': return self.max_queue[0][1]
+            case _: return self.last
+
+
+class Sampler:
+    """
+    Reads data sources in a background thread every SAMPLER_INTERVAL seconds
+    and keeps rolling aggregates of their numeric fields. Measuring data is
+    then taken from the aggregates without waiting for a read.
+    """
+    AGGREGATED_FIELDS = ('battery_charge_level', 'battery_charge_power', 'power_use', 'power_from_grid', 'power_from_pv',
+                         'power_self_consumption', 'power_feed_in', 'active_power')
+
+    def __init__(self, sources, interval=SAMPLER_INTERVAL, window=SAMPLER_WINDOW, ewma_time=SAMPLER_EWMA_TIME):
+        self.sources = [DATA_SOURCES[name] for name in sources]
+        self.interval = interval
+        self.window = window
+        self.ewma_time = ewma_time
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        # last result of each source and aggregate of each field
+        self.results = {}
+        self.aggregates = {}
+
+    def __enter__(self):
+        # the first sample is taken right away, so that measuring data is available from the start
+        self.sample()
+        self.worker = threading.Thread(target=self._run, name='helios-sampler', daemon=True)
+        self.worker.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop_event.set()
+        self.worker.join()
+        return False
+
+    def samples(self, name):
+        return any(source.name == name for source in self.sources)
+
+    def sample(self):
+        """Reads all sources once and adds their values to the aggregates."""
+        start = time.time()
+        for source in self.sources:
+            source.start()
+        for source in self.sources:
+            result = source.result(start + source.deadline - time.time())
+            with self.lock:
+                self.results[source.name] = result
+                if result.error:
+                    continue
+                for field, value in result.values.items():
+                    if field in Sampler.AGGREGATED_FIELDS:
+                        if field not in self.aggregates:
+                            self.aggregates[field] = RollingAggregate(self.window, self.ewma_time, int(self.window / self.interval) + 1)
+                        self.aggregates[field].add(value, result.timestamp)
+        METRICS.inc('helios_sampler_samples_total')
+
+    def _run(self):
+        while True:
+            start = time.monotonic()
+            try:
+                self.sample()
+            except Exception as e:
+                print(f'Error sampling data: {e!r}')
+            if self.stop_event.wait(max(self.interval - (time.monotonic() - start), 0)):
+                return
+
+    def result(self, name, statistic=None):
+        """Returns the last result of a source with the aggregated values instead of the read ones."""
+        source = DATA_SOURCES[name]
+        with self.lock:
+            result = self.results[name]
+            values = {field: self.aggregates[field].value(statistic) if field in self.aggregates else value
+                      for field, value in result.values.items()}
+        if not result.error and time.time() - result.timestamp > self.interval + source.deadline:
+            result = result._replace(error=HeliosException(f'Sampling of {name} is behind'))
+        return result._replace(values=values)
+
+
+class MeasuringData:
+    def __init__(self, prefer_modbus=False, sampler=None):
+        with METRICS.timer('helios_stage_seconds', stage='measuring_data'):
+            self._read(prefer_modbus, sampler)
+
+    def _read(self, prefer_modbus, sampler):
+        sources = ['converter'] if prefer_modbus else ['power_flow', 'power_details']
+        sources.append('wallbox')
+        # sources sampled in the background are taken from the sampler instead of being read
+        sampled = [name for name in sources if sampler and sampler.samples(name)]
+        # fields not read in time are filled with the last known values and their age in seconds is kept in stale
+        self.stale = {}
+        self.timestamp = time.time()
+        for name in sources:
+            if name not in sampled:
+                DATA_SOURCES[name].start()
+        for name in sources:
+            source = DATA_SOURCES[name]
+            if name in sampled:
+                result = sampler.result(name)
+            else:
+                result = source.result(self.timestamp + source.deadline - time.time())
+            for field, value in result.values.items():
+                setattr(self, field, value)
+                if result.error:
+                    self.stale[field] = self.timestamp - result.timestamp if result.timestamp else None
+
+    @classmethod
+    def from_values(cls, values, stale=None, timestamp=None):
+        """Creates measuring data from already known values instead of reading them."""
+        data = cls.__new__(cls)
+        data.__dict__.update(values)
+        data.stale = dict(stale or {})
+        data.timestamp = timestamp or time.time()
+        return data
+
+    def is_stale(self, *fields):
+        return any(field in self.stale for field in fields)
 
     def __str__(self):
         charging_status_values = {
@@ -528,12 +2144,404 @@ class MeasuringData:
         ret += f'Total energy: {self.total_energy} kWh\n'
         ret += f'Active power: {self.active_power} W\n'
         ret += f'RFID card: {self.rfid_card:0x}\n'
+        for field, age in self.stale.items():
+            ret += f'Stale: {field} ({"never read" if age is None else f"{age:.0f} s old"})\n'
         return ret
 
 
-if __name__ == '__main__':
-    with Display() as display:
-        designer = Designer(display)
+class RefreshScheduler:
+    """
+    Decides whether new data is worth a display refresh. A refresh is due if
+    the drawn state changed, like an arrow direction, or a value changed
+    significantly since the last drawn data. Refreshes are limited to one
+    every DISPLAY_MIN_REFRESH_TIME and forced every DISPLAY_REFRESH_TIME.
+    """
+    BATTERY_LEVELS = (10, 30, 50, 70, 90)
+
+    def __init__(self):
+        self.last_data = None
+        self.last_refresh = 0
+
+    def _grid_direction(self, data):
+        return data.power_from_grid - data.power_feed_in > 0
+
+    def _significant_changes(self, last, data):
+        reasons = []
+        if last.battery_charge_status != data.battery_charge_status:
+            reasons.append(f'battery {last.battery_charge_status} -> {data.battery_charge_status}')
+        if (last.charging_status == 3) != (data.charging_status == 3):
+            reasons.append('car charging started' if data.charging_status == 3 else 'car charging stopped')
+        if last.rfid_card != data.rfid_card:
+            reasons.append('RFID card changed')
+        if self._grid_direction(last) != self._grid_direction(data):
+            reasons.append('grid purchase' if self._grid_direction(data) else 'grid feed in')
+        if bool(last.power_from_pv) != bool(data.power_from_pv):
+            reasons.append('PV production started' if data.power_from_pv else 'PV production stopped')
+        if (bisect.bisect_left(RefreshScheduler.BATTERY_LEVELS, last.battery_charge_level) != bisect.bisect_left(RefreshScheduler.BATTERY_LEVELS, data.battery_charge_level)
+                or abs(data.battery_charge_level - last.battery_charge_level) >= DISPLAY_LEVEL_CHANGE):
+            reasons.append(f'battery level {last.battery_charge_level} -> {data.battery_charge_level} %')
+        for name, getter in (('battery power', lambda d: d.battery_charge_power),
+                             ('power use', lambda d: d.power_use),
+                             ('PV power', lambda d: d.power_from_pv),
+                             ('grid power', lambda d: abs(d.power_from_grid - d.power_feed_in)),
+                             ('car power', lambda d: d.active_power)):
+            old, new = getter(last), getter(data)
+            if abs(new - old) >= max(DISPLAY_POWER_CHANGE * abs(old), DISPLAY_POWER_CHANGE_MIN):
+                reasons.append(f'{name} {format_measurement(old, "W")} -> {format_measurement(new, "W")}')
+        if last.stale.keys() != data.stale.keys():
+            reasons.append('stale values changed')
+        return reasons
+
+    def check(self, data, now=None):
+        """Returns the reasons for a refresh with the given data, or an empty list if none is needed."""
+        now = now or time.monotonic()
+        if self.last_data is None:
+            reasons = ['first frame']
+        elif now - self.last_refresh >= DISPLAY_REFRESH_TIME:
+            reasons = ['maximum refresh interval reached']
+        else:
+            reasons = self._significant_changes(self.last_data, data)
+            if reasons and now - self.last_refresh < DISPLAY_MIN_REFRESH_TIME:
+                if VERBOSE:
+                    print(f'Postponing refresh until minimum interval is reached: {", ".join(reasons)}')
+                return []
+        if reasons:
+            print(f'Refreshing display: {", ".join(reasons)}')
+        elif VERBOSE:
+            print('No significant change, skipping refresh')
+        return reasons
+
+    def refreshed(self, data, now=None):
+        self.last_data = data
+        self.last_refresh = now or time.monotonic()
+
+
+class History:
+    """
+    Ring buffer of measured samples, persisted in a memory-mapped file.
+
+    The samples are stored as one array per field. New samples are collected
+    in memory and written in batches of HISTORY_FLUSH_SAMPLES to limit the
+    writes to the SD card. The file is recreated if its layout does not match.
+    """
+    MAGIC = b'HLHS'
+    HEADER = struct.Struct('<4sIIII')
+    FIELDS = (
+        ('timestamp', 'd'),
+        ('battery_charge_level', 'f'),
+        ('battery_charge_power', 'f'),
+        ('power_use', 'f'),
+        ('power_from_grid', 'f'),
+        ('power_from_pv', 'f'),
+        ('power_feed_in', 'f'),
+        ('active_power', 'f'),
+        ('charging_status', 'B'),
+    )
+
+    def __init__(self, path, capacity=HISTORY_SIZE):
+        self.path = path
+        self.capacity = capacity
+        self.pending = []
+        self.arrays = {}
+        self.field_index = {name: index for index, (name, fmt) in enumerate(History.FIELDS)}
+        self.layout = zlib.crc32(repr(History.FIELDS).encode())
+        # header is followed by the arrays of all fields, each padded to 8 bytes
+        offsets = []
+        size = History.HEADER.size + (-History.HEADER.size % 8)
+        for name, fmt in History.FIELDS:
+            offsets.append(size)
+            size += capacity * struct.calcsize(fmt)
+            size += -size % 8
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        try:
+            valid = os.fstat(fd).st_size == size
+            if not valid:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, stored_capacity, layout, self.head, self.count = History.HEADER.unpack_from(self.mm)
+        if not valid or magic != History.MAGIC or stored_capacity != capacity or layout != self.layout:
+            self.head = self.count = 0
+            self._write_header()
+
+        view = memoryview(self.mm)
+        for (name, fmt), offset in zip(History.FIELDS, offsets):
+            self.arrays[name] = view[offset:offset + capacity * struct.calcsize(fmt)].cast(fmt)
+        view.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def _write_header(self):
+        History.HEADER.pack_into(self.mm, 0, History.MAGIC, self.capacity, self.layout, self.head, self.count)
+
+    def __len__(self):
+        return min(self.count + len(self.pending), self.capacity)
+
+    def append(self, data, timestamp=None):
+        """Adds the sample of a MeasuringData or any object with the same fields."""
+        sample = [timestamp or getattr(data, 'timestamp', None) or time.time()]
+        sample += [getattr(data, name) for name, fmt in History.FIELDS[1:]]
+        self.pending.append([int(value) if fmt == 'B' else float(value) for (name, fmt), value in zip(History.FIELDS, sample)])
+        if len(self.pending) >= HISTORY_FLUSH_SAMPLES:
+            self.flush()
+
+    def flush(self):
+        for sample in self.pending:
+            for (name, fmt), value in zip(History.FIELDS, sample):
+                self.arrays[name][self.head] = value
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+        self.pending = []
+        self._write_header()
+        self.mm.flush()
+
+    def _get(self, name, index):
+        """Returns a field of the sample with the given index, 0 being the oldest sample."""
+        index += max(self.count + len(self.pending) - self.capacity, 0)
+        if index >= self.count:
+            return self.pending[index - self.count][self.field_index[name]]
+        return self.arrays[name][(self.head - self.count + index) % self.capacity]
+
+    def window(self, seconds, now=None):
+        """Returns all samples of the last seconds as dictionary of field name to list of values."""
+        start = (now or time.time()) - seconds
+        first = bisect.bisect_left(range(len(self)), start, key=lambda index: self._get('timestamp', index))
+        return {name: [self._get(name, index) for index in range(first, len(self))] for name, fmt in History.FIELDS}
+
+    def close(self):
+        self.flush()
+        for array in self.arrays.values():
+            array.release()
+        self.arrays = {}
+        self.mm.close()
+
+
+class Rollups:
+    """
+    Count, sum, minimum and maximum of each metric in buckets of several
+    resolutions, updated with every sample, so that queries do not depend on
+    the length of the history.
+
+    The metrics are the power values and the energies integrated from them
+    in Wh, including the energy charged by the wallbox for each RFID card.
+    Buckets are aligned to local time and persisted as JSON.
+    """
+    POWER_FIELDS = ('battery_charge_level', 'battery_charge_power', 'power_use', 'power_from_grid', 'power_from_pv',
+                    'power_feed_in', 'active_power')
+    ENERGY_FIELDS = {
+        'pv_energy': 'power_from_pv',
+        'consumption_energy': 'power_use',
+        'grid_import_energy': 'power_from_grid',
+        'grid_export_energy': 'power_feed_in',
+    }
+    # power is not integrated over longer gaps between samples, e.g. while Helios was not running
+    MAX_GAP = 5 * 60
+
+    def __init__(self, path, resolutions=ROLLUPS_RESOLUTIONS):
+        self.path = path
+        self.resolutions = resolutions
+        self.lock = threading.Lock()
+        # resolution name -> (list of bucket starts, list of buckets with metric name -> [count, sum, min, max])
+        self.buckets = {name: ([], []) for name in resolutions}
+        # previous sample, to integrate power and to compute the energy charged by the wallbox
+        self.last = None
+        self.last_flush = time.monotonic()
+        self._load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.last = data.get('last')
+        for name, (seconds, size) in self.resolutions.items():
+            stored = data['resolutions'].get(name)
+            # buckets of a changed resolution are dropped
+            if stored and stored['seconds'] == seconds:
+                buckets = stored['buckets'][-size:]
+                self.buckets[name] = ([start for start, bucket in buckets], [bucket for start, bucket in buckets])
+
+    def flush(self):
+        with self.lock:
+            data = {
+                'last': self.last,
+                'resolutions': {name: {'seconds': seconds, 'buckets': list(zip(*self.buckets[name]))}
+                                for name, (seconds, size) in self.resolutions.items()},
+            }
+        write_atomically(self.path, json.dumps(data, separators=(',', ':')))
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+
+    def _metrics(self, data, timestamp):
+        """Returns the values of all metrics of a sample."""
+        values = {field: getattr(data, field) for field in Rollups.POWER_FIELDS if not data.is_stale(field)}
+        last = self.last or {}
+        self.last = dict(values, timestamp=timestamp)
+        # the counter is only kept if it was read, e.g. a stale counter at the start is the default of 0, and the
+        # last real reading is kept over stale samples, so that the energy charged meanwhile is not lost
+        if not data.is_stale('total_energy'):
+            self.last['total_energy'] = data.total_energy
+        elif 'total_energy' in last:
+            self.last['total_energy'] = last['total_energy']
+        if not last:
+            return values
+
+        duration = timestamp - last['timestamp']
+        if 0 < duration <= Rollups.MAX_GAP:
+            for metric, field in Rollups.ENERGY_FIELDS.items():
+                if field in values and field in last:
+                    values[metric] = (values[field] + last[field]) / 2 * duration / 3600
+        # the counter of the wallbox is in kWh and only used if both readings are real and it did not reset
+        if 'total_energy' not in last or data.is_stale('total_energy'):
+            return values
+        charged = (data.total_energy - last['total_energy']) * 1000
+        if charged >= 0:
+            values['wallbox_energy'] = charged
+            if charged:
+                card = WALLBOX_RFID_CARDS.get(data.rfid_card, f'{data.rfid_card:x}')
+                values[f'wallbox_energy:{card}'] = charged
+        return values
+
+    def append(self, data, timestamp=None):
+        """Adds the sample of a MeasuringData to the buckets of all resolutions."""
+        timestamp = timestamp or data.timestamp
+        with self.lock:
+            values = self._metrics(data, timestamp)
+            offset = time.localtime(timestamp).tm_gmtoff
+            for name, (seconds, size) in self.resolutions.items():
+                start = timestamp - (timestamp + offset) % seconds
+                starts, buckets = self.buckets[name]
+                index = bisect.bisect_left(starts, start)
+                if index == len(starts):
+                    starts.append(start)
+                    buckets.append({})
+                    if len(starts) > size:
+                        del starts[0], buckets[0]
+                        index -= 1
+                elif starts[index] != start:
+                    # samples older than the last bucket, e.g. after the clock was changed, are dropped
+                    continue
+                bucket = buckets[index]
+                for metric, value in values.items():
+                    stats = bucket.get(metric)
+                    if stats is None:
+                        bucket[metric] = [1, value, value, value]
+                    else:
+                        stats[0] += 1
+                        stats[1] += value
+                        stats[2] = min(stats[2], value)
+                        stats[3] = max(stats[3], value)
+        if time.monotonic() - self.last_flush >= ROLLUPS_FLUSH_INTERVAL:
+            self.flush()
+
+    def query(self, resolution, start=None, end=None, metrics=None):
+        """Returns the buckets of a resolution starting in [start, end) with the statistics of the given or all metrics."""
+        if resolution not in self.resolutions:
+            raise HeliosException(f'Unknown resolution {resolution}, use one of {", ".join(self.resolutions)}')
+        with self.lock:
+            starts, buckets = self.buckets[resolution]
+            first = bisect.bisect_left(starts, start) if start is not None else 0
+            last = bisect.bisect_left(starts, end) if end is not None else len(starts)
+            result = []
+            for bucket_start, bucket in zip(starts[first:last], buckets[first:last]):
+                result.append({
+                    'start': bucket_start,
+                    'metrics': {metric: {'count': count, 'sum': total, 'min': minimum, 'max': maximum, 'mean': total / count}
+                                for metric, (count, total, minimum, maximum) in bucket.items() if not metrics or metric in metrics},
+                })
+        return result
+
+    def _response(self, path, params):
+        """Returns status, headers and body of the response to a request."""
+        try:
+            if path != '/rollups':
+                raise HeliosException(f'Unknown path {path}')
+            status = 200
+            response = self.query(params.get('resolution', '1h'),
+                                  float(params['start']) if 'start' in params else None,
+                                  float(params['end']) if 'end' in params else None,
+                                  params['metrics'].split(',') if 'metrics' in params else None)
+        except (HeliosException, ValueError) as e:
+            status = 400
+            response = {'error': str(e)}
+        return status, {'Content-Type': 'application/json'}, json.dumps(response).encode()
+
+    def serve(self, port):
+        """
+        Serves the rollups on localhost in a background thread, e.g.
+        /rollups?resolution=1d&start=1700000000&end=1700600000&metrics=pv_energy,wallbox_energy
+        """
+        return serve_http('127.0.0.1', port, lambda path, params, headers: self._response(path, params), 'helios-rollups')
+
+
+def run_frame_client():
+    with Display(frame_path=os.path.join(STATE_DIR, DISPLAY_FRAME_FILE)) as display:
+        client = FrameClient(display, FRAME_SOURCE_URL)
+        while True:
+            start = time.monotonic()
+            try:
+                client.poll()
+            except Exception as e:
+                print(f'Error showing frame: {e!r}')
+            time.sleep(max(SAMPLE_TIME - (time.monotonic() - start), 0))
+
+
+def run_gauge():
+    sampled_sources = ['converter', 'wallbox'] if CONVERTER_PREFER_MODBUS else ['wallbox']
+    with (Display(frame_path=os.path.join(STATE_DIR, DISPLAY_FRAME_FILE)) as display, AsyncDisplay(display) as async_display,
+          History(os.path.join(STATE_DIR, HISTORY_FILE)) as history, Rollups(os.path.join(STATE_DIR, ROLLUPS_FILE)) as rollups,
+          Sampler(sampled_sources) if SAMPLER_INTERVAL else contextlib.nullcontext() as sampler):
+        if METRICS_PORT:
+            try:
+                METRICS.serve(METRICS_PORT)
+            except OSError as e:
+                # the metrics are optional, the gauge keeps showing data without them
+                print(f'Error serving metrics on port {METRICS_PORT}: {e!r}')
+        if ROLLUPS_PORT:
+            try:
+                rollups.serve(ROLLUPS_PORT)
+            except OSError as e:
+                # the rollups are still collected and persisted without serving them
+                print(f'Error serving rollups on port {ROLLUPS_PORT}: {e!r}')
+        frontend = async_display
+        if FRAME_SERVER_PORT:
+            frontend = FrameServer(async_display)
+            frontend.serve(FRAME_SERVER_HOST, FRAME_SERVER_PORT)
+        designer = Designer(frontend)
+        scheduler = RefreshScheduler()
         while True:
-            designer.draw_data(MeasuringData())
-            time.sleep(DISPLAY_REFRESH_TIME)
+            start = time.monotonic()
+            data = MeasuringData(prefer_modbus=CONVERTER_PREFER_MODBUS, sampler=sampler)
+            history.append(data)
+            rollups.append(data)
+            if scheduler.check(data):
+                designer.draw_data(data)
+                scheduler.refreshed(data)
+            if METRICS_TEXTFILE:
+                METRICS.write_textfile(METRICS_TEXTFILE)
+            time.sleep(max(SAMPLE_TIME - (time.monotonic() - start), 0))
+
+
+if __name__ == '__main__':
+    if FRAME_SOURCE_URL:
+        run_frame_client()
+    else:
+        run_gauge()
@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+"""
+Stand-in servers for the wallbox, the converter and the SolarEdge API.
+
+The wallbox and converter are served by small Modbus TCP servers, the API
+by a local HTTP server. All of them serve the values of one simulated
+installation and can inject latency, timeouts, dropped connections and HTTP
+429 responses.
+
+Usage:
+    ./simulator.py serve [options]   run the servers until interrupted
+    ./simulator.py load [options]    run acquisition cycles of helios.py
+                                     against the servers and report the
+                                     throughput and latency of each source
+"""
+
+import sys
+import json
+import time
+import random
+import select
+import struct
+import argparse
+import datetime
+import threading
+import statistics
+import socketserver
+import urllib.parse
+import http.server
+
+import helios
+
+
+class Faults:
+    """Faults injected into the responses of a server."""
+    def __init__(self, latency=0, jitter=0, timeout=0, drop=0, http_429=0, hang_time=30, close=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.timeout = timeout
+        self.drop = drop
+        self.close = close
+        self.http_429 = http_429
+        self.hang_time = hang_time
+
+    def delay(self):
+        """Waits for the response latency, or much longer for requests chosen to time out."""
+        if self.timeout and random.random() < self.timeout:
+            time.sleep(self.hang_time)
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    def dropped(self):
+        return self.drop and random.random() < self.drop
+
+    def closed(self):
+        return self.close and random.random() < self.close
+
+    def rate_limited(self):
+        return self.http_429 and random.random() < self.http_429
+
+
+class Installation:
+    """Simulated house with PV, battery and wallbox, whose values drift randomly."""
+    def __init__(self, seed=None, battery=True):
+        self.random = random.Random(seed)
+        self.battery = battery
+        self.lock = threading.Lock()
+        self.pv = 3000.0
+        self.consumption = 800.0
+        self.battery_level = 55.0
+        self.battery_power = 1200.0
+        self.charging_status = 2
+        self.car_power = 0.0
+        self.total_energy = 1234567
+        self.rfid_card = 0x12345678
+
+    def update(self):
+        with self.lock:
+            self.pv = max(self.pv + self.random.gauss(0, 150), 0)
+            self.consumption = max(self.consumption + self.random.gauss(0, 80), 150)
+            if self.random.random() < 0.02:
+                self.charging_status = 2 if self.charging_status == 3 else 3
+            self.car_power = 11000.0 if self.charging_status == 3 else 0.0
+            surplus = self.pv - self.consumption - self.car_power
+            self.battery_power = max(min(surplus, 5000), -5000) if 5 < self.battery_level < 100 or surplus * (self.battery_level - 50) < 0 else 0
+            if not self.battery:
+                self.battery_power = 0
+            self.battery_level = max(min(self.battery_level + self.battery_power / 10000 / 60, 100), 0)
+            self.total_energy += int(self.car_power / 360)
+
+    def values(self):
+        """Returns all values, with the grid power derived from the power balance."""
+        with self.lock:
+            load = self.consumption + self.car_power
+            grid = load + self.battery_power - self.pv
+            return {
+                'pv': self.pv,
+                'load': load,
+                'battery': self.battery,
+                'battery_level': self.battery_level,
+                'battery_power': self.battery_power,
+                'battery_status': 'Charging' if self.battery_power > 0 else 'Discharging' if self.battery_power < 0 else 'Idle',
+                'purchased': max(grid, 0),
+                'feed_in': max(-grid, 0),
+                'self_consumption': min(self.pv, load),
+                'charging_status': self.charging_status,
+                'car_power': self.car_power,
+                'total_energy': self.total_energy,
+                'rfid_card': self.rfid_card,
+            }
+
+
+def words(fmt, value, word_order='big'):
+    """Encodes a value as list of 16 bit registers."""
+    data = struct.pack('>' + fmt, value)
+    regs = list(struct.unpack(f'>{len(data) // 2}H', data))
+    return regs[::-1] if word_order == 'little' else regs
+
+
+def text(value, count):
+    """Encodes a string as registers of two characters each."""
+    data = value.encode().ljust(count * 2, b'\0')[:count * 2]
+    return list(struct.unpack(f'>{count}H', data))
+
+
+def wallbox_registers(values):
+    """
+    Registers of a KEBA P30 wallbox.
+
+    References:
+     - https://www.keba.com/download/x/dea7ae6b84/kecontactp30modbustcp_pgen.pdf
+    """
+    registers = {}
+    for address, value in ((1000, values['charging_status']),
+                           (1020, int(values['car_power'] * 1000)),
+                           (1036, values['total_energy']),
+                           (1500, values['rfid_card']),
+                           (1502, 0)):
+        registers.update(enumerate(words('I', value), address))
+    return registers
+
+
+def converter_registers(values):
+    """
+    Registers of a SolarEdge converter with SunSpec models for the converter
+    and the meter, followed by the registers of the first battery.
+
+    References:
+     - https://knowledge-center.solaredge.com/sites/kc/files/sunspec-implementation-technical-note.pdf
+    """
+    registers = {}
+
+    def block(address, regs):
+        registers.update(enumerate(regs, address))
+        return address + len(regs)
+
+    address = block(40000, text('SunS', 2))
+    # common model
+    common = text('SolarEdge', 16) + text('SE10K-RWS', 16) + [0] * 8 + text('0004.0020.0036', 8) + text('SIMULATED', 16) + [1]
+    address = block(address, [1, len(common)] + common)
+    # three phase inverter model, W and DCW scaled by 10^0
+    inverter = [0] * 50
+    # the battery is DC coupled, so its charge power is not part of the AC output
+    inverter[12] = int(values['pv'] - values['battery_power']) & 0xffff
+    inverter[13] = 0
+    inverter[14] = 5000
+    inverter[15] = (-2) & 0xffff
+    inverter[29] = int(values['pv'] - values['battery_power']) & 0xffff
+    inverter[30] = 0
+    inverter[36] = 4
+    address = block(address, [103, len(inverter)] + inverter)
+    # meter common model and wye-connect three phase meter model, positive power is exported to the grid
+    meter_common = text('WattNode', 16) + text('SE-MTR-3Y', 16) + text('Export+Import', 8) + text('0001', 8) + text('METER1', 16) + [2]
+    address = block(address, [1, len(meter_common)] + meter_common)
+    meter = [0] * 105
+    meter[16] = int(values['feed_in'] - values['purchased']) & 0xffff
+    meter[20] = 0
+    address = block(address, [203, len(meter)] + meter)
+    block(address, [0xffff, 0])
+
+    if not values['battery']:
+        return registers
+    # battery 1, floats with little-endian word order
+    battery_status = {'Charging': 3, 'Discharging': 4, 'Idle': 7}[values['battery_status']]
+    battery = {
+        0xE142: ('f', 10000.0),
+        0xE174: ('f', values['battery_power']),
+        0xE180: ('f', values['battery_level'] * 100),
+        0xE184: ('f', values['battery_level']),
+        0xE186: ('I', battery_status),
+    }
+    # all registers of the battery block are defined, unlike the ones of the wallbox
+    registers.update(enumerate([0] * 0xA0, 0xE100))
+    registers.update(enumerate(text('LG', 16), 0xE100))
+    for address, (fmt, value) in battery.items():
+        registers.update(enumerate(words(fmt, value, 'little'), address))
+    return registers
+
+
+class ModbusHandler(socketserver.BaseRequestHandler):
+    """Modbus TCP handler answering 'read holding registers' requests."""
+    FC_READ_HOLDING_REGISTERS = 0x03
+    EXCEPTION_ILLEGAL_FUNCTION = 0x01
+    EXCEPTION_ILLEGAL_ADDRESS = 0x02
+    IDLE_TIME = 0.1
+
+    def _recv(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def handle(self):
+        server = self.server
+        while True:
+            header = self._recv(7)
+            if not header:
+                return
+            transaction, protocol, length, unit = struct.unpack('>HHHB', header)
+            pdu = self._recv(length - 1)
+            if pdu is None:
+                return
+            server.stats['requests'] += 1
+            server.faults.delay()
+            if server.faults.dropped():
+                server.stats['dropped'] += 1
+                return
+            function = pdu[0]
+            if function != ModbusHandler.FC_READ_HOLDING_REGISTERS:
+                response = struct.pack('>BB', function | 0x80, ModbusHandler.EXCEPTION_ILLEGAL_FUNCTION)
+            else:
+                address, count = struct.unpack('>HH', pdu[1:5])
+                registers = server.registers(server.installation.values())
+                # like the devices, reads covering any undefined register are rejected
+                if any(a not in registers for a in range(address, address + count)):
+                    response = struct.pack('>BB', function | 0x80, ModbusHandler.EXCEPTION_ILLEGAL_ADDRESS)
+                else:
+                    regs = [registers[a] for a in range(address, address + count)]
+                    response = struct.pack(f'>BB{count}H', function, count * 2, *regs)
+            self.request.sendall(struct.pack('>HHHB', transaction, protocol, len(response) + 1, unit) + response)
+            # like devices closing idle connections, found broken only on the next request
+            if not select.select([self.request], [], [], ModbusHandler.IDLE_TIME)[0] and server.faults.closed():
+                return
+
+
+class ModbusServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, registers, installation, faults):
+        super().__init__(address, ModbusHandler)
+        self.registers = registers
+        self.installation = installation
+        self.faults = faults
+        self.stats = {'requests': 0, 'dropped': 0}
+
+
+class ApiHandler(http.server.BaseHTTPRequestHandler):
+    """Handler emulating the currentPowerFlow and powerDetails endpoints of the SolarEdge API."""
+    DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _power(self, value):
+        return round(value / 1000, 5) if self.server.unit == 'kW' else round(value, 2)
+
+    def _power_flow(self, values):
+        return {'siteCurrentPowerFlow': {
+            'updateRefreshRate': 3,
+            'unit': self.server.unit,
+            'connections': [],
+            'GRID': {'status': 'Active', 'currentPower': self._power(values['purchased'] + values['feed_in'])},
+            'LOAD': {'status': 'Active', 'currentPower': self._power(values['load'])},
+            'PV': {'status': 'Active', 'currentPower': self._power(values['pv'])},
+            'STORAGE': {'status': values['battery_status'], 'currentPower': self._power(abs(values['battery_power'])),
+                        'chargeLevel': round(values['battery_level']), 'critical': False},
+        }}
+
+    def _power_details(self, values, query):
+        start = datetime.datetime.strptime(query['startTime'][0], ApiHandler.DATE_FORMAT)
+        end = datetime.datetime.strptime(query['endTime'][0], ApiHandler.DATE_FORMAT)
+        quarter = start.replace(minute=start.minute - start.minute % 15, second=0, microsecond=0)
+        dates = []
+        while quarter <= end:
+            dates.append(quarter)
+            quarter += datetime.timedelta(minutes=15)
+        meters = []
+        for meter_type, key in (('Production', 'pv'), ('Consumption', 'load'), ('SelfConsumption', 'self_consumption'),
+                                ('FeedIn', 'feed_in'), ('Purchased', 'purchased')):
+            entries = [{'date': date.strftime(ApiHandler.DATE_FORMAT), 'value': self._power(values[key])} for date in dates]
+            # the current quarter of an hour has no value yet
+            if entries:
+                del entries[-1]['value']
+            meters.append({'type': meter_type, 'values': entries})
+        return {'powerDetails': {'timeUnit': 'QUARTER_OF_AN_HOUR', 'unit': self.server.unit, 'meters': meters}}
+
+    def do_GET(self):
+        server = self.server
+        server.stats['requests'] += 1
+        server.faults.delay()
+        if server.faults.dropped():
+            server.stats['dropped'] += 1
+            self.close_connection = True
+            return
+        if server.faults.rate_limited():
+            server.stats['rate_limited'] += 1
+            self._send_json(429, {'String': 'Too many requests'})
+            return
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        endpoint = url.path.rsplit('/', 1)[-1]
+        values = server.installation.values()
+        if endpoint == 'currentPowerFlow':
+            self._send_json(200, self._power_flow(values))
+        elif endpoint == 'powerDetails' and 'startTime' in query and 'endTime' in query:
+            self._send_json(200, self._power_details(values, query))
+        else:
+            self._send_json(404, {'String': 'Not found'})
+
+
+class ApiServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, installation, faults, unit='kW'):
+        super().__init__(address, ApiHandler)
+        self.installation = installation
+        self.faults = faults
+        self.unit = unit
+        self.stats = {'requests': 0, 'dropped': 0, 'rate_limited': 0}
+
+
+def start_servers(args):
+    """Starts all servers in background threads and returns them."""
+    installation = Installation(args.seed, not args.no_battery)
+    modbus_faults = Faults(args.latency, args.jitter, args.timeout, args.drop, close=args.close)
+    api_faults = Faults(args.api_latency, args.jitter, args.timeout, args.drop, args.http_429)
+    servers = {
+        'wallbox': ModbusServer((args.host, args.wallbox_port), wallbox_registers, installation, modbus_faults),
+        'converter': ModbusServer((args.host, args.converter_port), converter_registers, installation, modbus_faults),
+        'api': ApiServer((args.host, args.api_port), installation, api_faults, args.unit),
+    }
+    for server in servers.values():
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def drift():
+        while True:
+            installation.update()
+            time.sleep(1)
+    threading.Thread(target=drift, daemon=True).start()
+    return servers
+
+
+def configure_helios(args):
+    """Points helios.py to the local servers and lifts the API budget."""
+    helios.WALLBOX_IP = helios.CONVERTER_IP = args.host
+    helios.WALLBOX_PORT = args.wallbox_port
+    helios.CONVERTER_PORT = args.converter_port
+    helios.SOLAREDGE_API_URL = f'http://{args.host}:{args.api_port}'
+    helios.SOLAREDGE_API_KEY = 'SIMULATED'
+    helios.SOLAREDGE_SITE_ID = '1'
+    helios.SOLAREDGE_DAILY_LIMIT = 10 ** 9
+    helios.SOLAREDGE_MIN_INTERVAL = 0
+    helios.STATE_DIR = args.state_dir
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)] if values else float('nan')
+
+
+def run_load(args):
+    servers = start_servers(args)
+    configure_helios(args)
+
+    latencies = {name: [] for name in helios.DATA_SOURCES}
+    errors = {name: 0 for name in helios.DATA_SOURCES}
+    for name, source in helios.DATA_SOURCES.items():
+        def timed(read_func=source.read_func, name=name):
+            start = time.perf_counter()
+            try:
+                return read_func()
+            except Exception:
+                errors[name] += 1
+                raise
+            finally:
+                latencies[name].append(time.perf_counter() - start)
+        source.read_func = timed
+
+    cycles = []
+    stale = 0
+    start = time.perf_counter()
+    for _ in range(args.cycles):
+        cycle_start = time.perf_counter()
+        data = helios.MeasuringData(prefer_modbus=args.prefer_modbus)
+        cycles.append(time.perf_counter() - cycle_start)
+        stale += bool(data.stale)
+        time.sleep(args.interval)
+    duration = time.perf_counter() - start
+
+    print(f'Cycles: {args.cycles} in {duration:.2f} s, {args.cycles / duration:.1f} cycles/s, {stale} with stale values')
+    print(f'{"source":<14}{"reads":>7}{"errors":>8}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"max ms":>9}')
+    for name, values in list(latencies.items()) + [('cycle', cycles)]:
+        if not values:
+            continue
+        values_ms = [value * 1000 for value in values]
+        print(f'{name:<14}{len(values):>7}{errors.get(name, 0):>8}{statistics.median(values_ms):>9.1f}'
+              f'{percentile(values_ms, 95):>9.1f}{percentile(values_ms, 99):>9.1f}{max(values_ms):>9.1f}')
+    for name, server in servers.items():
+        print(f'Server {name}: {server.stats}')
+    return 0
+
+
+def run_serve(args):
+    servers = start_servers(args)
+    print(f'Wallbox Modbus on {args.host}:{args.wallbox_port}, converter Modbus on {args.host}:{args.converter_port}, '
+          f'SolarEdge API on http://{args.host}:{args.api_port}')
+    try:
+        while True:
+            time.sleep(60)
+            print({name: server.stats for name, server in servers.items()})
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Helios Power Gauge stand-in servers')
+    parser.add_argument('mode', choices=['serve', 'load'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--wallbox-port', type=int, default=5020)
+    parser.add_argument('--converter-port', type=int, default=5021)
+    parser.add_argument('--api-port', type=int, default=8080)
+    parser.add_argument('--unit', choices=['W', 'kW'], default='kW', help='power unit of the API responses')
+    parser.add_argument('--latency', type=float, default=0.01, help='Modbus response latency in seconds')
+    parser.add_argument('--api-latency', type=float, default=0.2, help='API response latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0, help='additional random latency in seconds')
+    parser.add_argument('--timeout', type=float, default=0, help='share of requests not answered in time')
+    parser.add_argument('--drop', type=float, default=0, help='share of requests closing the connection')
+    parser.add_argument('--close', type=float, default=0, help='share of idle Modbus connections closed by the server')
+    parser.add_argument('--http-429', type=float, default=0, help='share of API requests answered with HTTP 429')
+    parser.add_argument('--seed', type=int, help='seed for the simulated values')
+    parser.add_argument('--no-battery', action='store_true', help='simulate a converter without battery')
+    parser.add_argument('--cycles', type=int, default=100, help='number of acquisition cycles (load)')
+    parser.add_argument('--interval', type=float, default=0, help='pause between acquisition cycles in seconds (load)')
+    parser.add_argument('--prefer-modbus', action='store_true', help='read the converter by Modbus instead of the API (load)')
+    parser.add_argument('--state-dir', default='/tmp', help='directory for files persisted by helios.py (load)')
+    args = parser.parse_args()
+    return run_load(args) if args.mode == 'load' else run_serve(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())